@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Размер запроса на саммари результатов поиска: до и после prepare_results/search_prompt.
+
+«До» — как было: в OpenAI и пользователю уходит один и тот же markdown
+format_results() с первыми num результатами DDGS (заголовки, сниппеты, ссылки).
+«После» — результаты без дублей по сайту и перепечаток, ранжированные по запросу;
+в OpenAI — search_prompt() без ссылок в пределах SEARCH_PROMPT_TOKENS,
+пользователю — format_results() по тем же результатам.
+
+Токены считаются той же оценкой, что и в боте (estimate_tokens); сеть не нужна.
+
+    python benchmarks/bench_search_prompt.py --queries 500
+    python benchmarks/bench_search_prompt.py --results saved_ddgs.json
+
+saved_ddgs.json — список {"query": ..., "results": [ответ DDGS.text(...)]},
+например собранный из логов настоящего бота.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("BOT_USERNAME", "mama_bot")
+
+import bot  # noqa: E402
+
+TOPICS = [
+    "курс биткоина", "погода в москве", "ошибка деплоя кубернетес", "рецепт борща",
+    "postgres репликация отстаёт", "nginx 504 таймаут", "python 3.12 asyncio", "новости графана",
+]
+SYLLABLES = "ка ро ми на те ли по за ре ва ст ор ан ко ль ди ны пр об ис".split()
+DOMAINS = [
+    "ru.wikipedia.org", "habr.com", "dzen.ru", "rbc.ru", "lenta.ru", "stackoverflow.com",
+    "vc.ru", "kommersant.ru", "github.com", "pikabu.ru",
+]
+
+
+def make_word(rnd: random.Random) -> str:
+    """Псевдослово: словарь должен быть большим, иначе любые два сниппета похожи"""
+    return "".join(rnd.choices(SYLLABLES, k=rnd.randint(2, 4)))
+
+
+def make_snippet(rnd: random.Random, topic: str) -> str:
+    words = [make_word(rnd) for _ in range(rnd.randint(20, 40))]
+    words.insert(rnd.randint(0, len(words)), topic)
+    return " ".join(words).capitalize() + "."
+
+
+def reprint(rnd: random.Random, snippet: str) -> str:
+    """Перепечатка новости: тот же текст с парой изменённых слов"""
+    words = snippet.split()
+    for _ in range(2):
+        words[rnd.randrange(len(words))] = make_word(rnd)
+    return " ".join(words)
+
+
+def make_results(rnd: random.Random, topic: str, count: int) -> list:
+    results = []
+    for _ in range(count):
+        # Популярные сайты встречаются в выдаче по нескольку раз
+        domain = rnd.choice(DOMAINS[:4]) if rnd.random() < 0.5 else rnd.choice(DOMAINS)
+        if results and rnd.random() < 0.3:
+            body = reprint(rnd, rnd.choice(results)["body"])
+        else:
+            body = make_snippet(rnd, topic)
+        slug = "-".join(make_word(rnd) for _ in range(rnd.randint(3, 8)))
+        results.append({
+            "title": f"{topic.capitalize()} — {' '.join(make_word(rnd) for _ in range(rnd.randint(2, 6)))}",
+            "body": body,
+            "href": f"https://{domain}/{rnd.randint(2019, 2025)}/{slug}?utm_source=ddg&id={rnd.randint(1, 10**6)}",
+        })
+    return results
+
+
+def load_corpus(args) -> list:
+    if args.results:
+        with open(args.results, encoding="utf-8") as f:
+            return [(item["query"], item["results"]) for item in json.load(f)]
+    rnd = random.Random(args.seed)
+    return [
+        (topic, make_results(rnd, topic, args.num + bot.SEARCH_OVERFETCH))
+        for topic in rnd.choices(TOPICS, k=args.queries)
+    ]
+
+
+def request_tokens(query: str, prompt_md: str) -> int:
+    return sum(bot.estimate_tokens(m["content"]) for m in bot.summary_request(query, prompt_md)["messages"])
+
+
+def before(query: str, results: list, num: int):
+    results_md = bot.format_results(results, num)
+    return request_tokens(query, results_md), len(results_md), min(num, len(results))
+
+
+def after(query: str, results: list, num: int):
+    kept = bot.prepare_results(query, results, num)
+    prompt_md = bot.search_prompt(kept)
+    return request_tokens(query, prompt_md), len(bot.format_results(kept)), len(kept)
+
+
+def measure(name: str, fn, corpus, num: int, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = [fn(query, results, num) for query, results in corpus]
+        best = min(best, time.perf_counter() - start)
+    tokens = sorted(row[0] for row in rows)
+    stats = {
+        "tokens_mean": sum(tokens) / len(tokens),
+        "tokens_p95": tokens[int(len(tokens) * 0.95) - 1],
+        "reply_chars": sum(row[1] for row in rows) / len(rows),
+        "results": sum(row[2] for row in rows) / len(rows),
+        "us_per_search": best / len(corpus) * 1e6,
+    }
+    print(f"{name:<8} {stats['tokens_mean']:10.0f} {stats['tokens_p95']:10.0f} "
+          f"{stats['reply_chars']:12.0f} {stats['results']:9.1f} {stats['us_per_search']:10.1f}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--num", type=int, default=5, help="сколько результатов показывать")
+    parser.add_argument("--results", help="JSON с сохранёнными ответами DDGS вместо синтетики")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+    print(f"corpus: {len(corpus)} searches, budget {bot.SEARCH_PROMPT_TOKENS} tokens\n")
+    print(f"{'':<8} {'tokens':>10} {'tokens p95':>10} {'reply chars':>12} {'results':>9} {'µs/search':>10}")
+    old = measure("before", before, corpus, args.num, args.repeat)
+    new = measure("after", after, corpus, args.num, args.repeat)
+    print(f"\nsummary prompt tokens: -{1 - new['tokens_mean'] / old['tokens_mean']:.0%}, "
+          f"user reply: -{1 - new['reply_chars'] / old['reply_chars']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк разбора триггеров в chat().
+
+Сравнивает старый путь (re.search + re.sub на каждое сообщение, паттерны
+собираются заново) с TriggerMatcher на большом синтетическом корпусе
+групповых сообщений.
+
+    python benchmarks/bench_triggers.py --messages 200000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("BOT_USERNAME", "mama_bot")
+
+import bot  # noqa: E402
+
+WORDS = (
+    "привет как дела кто идёт на пиво вечером сервер опять упал деплой "
+    "в пятницу это плохая идея кубер логи графана алерт сеть пропала "
+    "найдёте зарядку интернет тормозит поиск работы гугл докс"
+).split()
+
+
+def make_corpus(n: int, addressed_share: float, seed: int = 42):
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        words = rnd.choices(WORDS, k=rnd.randint(3, 30))
+        if rnd.random() < addressed_share:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(["@mama_bot", "мразь"]))
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def legacy(text: str, username: str):
+    """Логика chat() до TriggerMatcher: поиск проверялся на каждом сообщении"""
+    text_lower = text.lower()
+    if re.search(r"(интернет|сеть|поиск|гугл(и|я|ить)?|погугл(и|я|ить)?|найд)", text_lower):
+        query = re.sub(r"(интернет|сеть|поиск|гугл(и|я|ить)?|погугл(и|я|ить)?|найд)", "", text, flags=re.IGNORECASE).strip()
+        return "search", query or text
+    if not (f"@{username}".lower() in text_lower or "мразь" in text_lower):
+        return None
+    return "chat", re.sub(fr"@{re.escape(username)}|мразь", "", text, flags=re.IGNORECASE).strip()
+
+
+def bench(name: str, fn, corpus, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    per_msg = best / len(corpus) * 1e6
+    print(f"{name:<16} {best * 1000:9.1f} ms  {per_msg:7.2f} µs/msg")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--addressed", type=float, default=0.05, help="доля сообщений с обращением к боту")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.messages, args.addressed)
+    matcher = bot.TriggerMatcher("mama_bot")
+
+    legacy_hits = sum(1 for t in corpus if legacy(t, "mama_bot") and legacy(t, "mama_bot")[0] == "search")
+    new_hits = sum(1 for t in corpus if matcher.match(t).search)
+    print(f"corpus: {len(corpus)} group messages, {args.addressed:.0%} addressed")
+    print(f"search launches: legacy={legacy_hits} matcher={new_hits}\n")
+
+    old = bench("legacy", lambda t: legacy(t, "mama_bot"), corpus, args.repeat)
+    new = bench("TriggerMatcher", matcher.match, corpus, args.repeat)
+    print(f"\nspeedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
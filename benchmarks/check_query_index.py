@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка индекса похожих запросов (QueryIndex) на парах запросов.
+
+Пары из MUST_DIFFER никогда не должны получать чужие результаты: другой день,
+отрицание, антоним, другой порядок слов, другое число — при любом пороге.
+Пары из MUST_MERGE — перефразировки, которые индекс обязан склеить при
+пороге по умолчанию. Запросы проходят через разбор триггеров, как в chat().
+Печатает сходство и решение индекса; при ошибке выходит с кодом 1.
+
+    python benchmarks/check_query_index.py
+    python benchmarks/check_query_index.py --threshold 0.7
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("BOT_USERNAME", "mama_bot")
+
+import bot  # noqa: E402
+
+MUST_DIFFER = [
+    ("погода в санкт-петербурге сегодня", "погода в санкт-петербурге завтра"),
+    ("курс доллара вчера", "курс доллара сегодня"),
+    ("афиша на выходные в июне", "афиша на выходные в июле"),
+    ("расписание электричек москва тверь", "расписание электричек тверь москва"),
+    ("лучший ноутбук для программиста", "худший ноутбук для программиста"),
+    ("как убить процесс", "как не убить процесс"),
+    ("можно ли пить кофе", "нельзя ли пить кофе"),
+    ("как включить firewall", "как выключить firewall"),
+    ("python 3.11 asyncio", "python 3.12 asyncio"),
+]
+
+MUST_MERGE = [
+    ("найди курс биткоина", "погугли курс биткоина сегодня"),
+    ("курс биткоина", "курс биткоина пожалуйста"),
+    ("погода в москве", "погода москва"),
+    ("новости про графану", "новости графана"),
+]
+
+
+def search_query(text: str) -> str:
+    return bot.TRIGGERS.match(text, private=True).query
+
+
+def merges(index, a: str, b: str) -> bool:
+    index.add(search_query(a), 5, [{"title": a}])
+    found = index.lookup(search_query(b), 5)
+    return found is not None and found[0]["title"] == a
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threshold", type=float, default=bot.QUERY_INDEX_THRESHOLD)
+    args = parser.parse_args()
+    if bot.query_index() is None:
+        sys.exit("QueryIndex выключен или нет numpy")
+
+    failed = 0
+    for expected, pairs in (("differ", MUST_DIFFER), ("merge", MUST_MERGE)):
+        for a, b in pairs:
+            index = bot.QueryIndex(16, 60, args.threshold)
+            similarity = index.similarity(search_query(a), search_query(b))
+            got = "merge" if merges(index, a, b) else "differ"
+            ok = got == expected
+            failed += not ok
+            print(f"{'ok ' if ok else 'FAIL'} {similarity:5.2f} {got:<7} {a!r} / {b!r}")
+    print(f"\nthreshold {args.threshold}: {failed} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
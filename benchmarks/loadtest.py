@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн нагрузочный тест бота.
+
+Гоняет настоящие хэндлеры bot.py (chat, cmd_style, cmd_admin, cmd_ping, ...)
+синтетическим потоком апдейтов: много чатов, смесь поиска, обычных ответов и
+команд, всплески. Telegram, OpenAI и DDGS заменены локальными заглушками с
+настраиваемой задержкой и долей ошибок — в сеть ничего не уходит.
+
+Отчёт: пропускная способность, p50/p95/p99 по путям (search, chat, command,
+ignored) и задержка event loop.
+
+    python benchmarks/loadtest.py --updates 2000 --rate 200 --chats 100
+    python benchmarks/loadtest.py --json before.json
+    python benchmarks/loadtest.py --compare HEAD~5 HEAD
+
+В режиме --compare обе ревизии выкладываются через git worktree во временные
+каталоги, и этот же скрипт прогоняется против каждого bot.py.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+BOT_USERNAME = "mama_bot"
+
+QUERY_WORDS = (
+    "курс биткоина погода москва новости кубернетес ошибка деплоя пиво баня "
+    "графана алерты postgres репликация nginx таймаут docker compose python asyncio"
+).split()
+CHAT_WORDS = "привет как дела что думаешь про пятничный деплой и упавший прод расскажи анекдот".split()
+
+
+# ─── ЗАГЛУШКИ ───────────────────────────────────────────────────────
+class Latency:
+    """Логнормальная задержка со средним mean и доля ошибок errors"""
+
+    def __init__(self, mean: float, errors: float, rnd: random.Random):
+        self.mean = mean
+        self.errors = errors
+        self.rnd = rnd
+
+    def sample(self) -> float:
+        if self.mean <= 0:
+            return 0.0
+        return self.rnd.lognormvariate(0, 0.5) * self.mean / 1.133  # E[lognorm(0, .5)] ≈ 1.133
+
+    def fails(self) -> bool:
+        return self.rnd.random() < self.errors
+
+
+class FakeBot:
+    """Минимальный Bot: send_message / edit_message_text с задержкой и сбоями сети"""
+
+    defaults = None
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.sent = 0
+        self.edits = 0
+        self._next_id = 10_000_000
+
+    async def _network(self):
+        from telegram.error import NetworkError
+        await asyncio.sleep(self.latency.sample())
+        if self.latency.fails():
+            raise NetworkError("fake network error")
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        await self._network()
+        self.sent += 1
+        self._next_id += 1
+        message_id = self._next_id
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text,
+                               edit_text=lambda t, **kw: self.edit_message_text(t, chat_id, message_id))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        await self._network()
+        self.edits += 1
+        return True
+
+
+class FakeOpenAI:
+    """Подменяет AsyncOpenAI: chat.completions.create с задержкой, ошибками и стримингом"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model="gpt-4o-mini", messages=(), stream=False, **kwargs):
+        self.calls += 1
+        total = self.latency.sample()
+        if self.latency.fails():
+            await asyncio.sleep(total / 2)
+            raise RuntimeError("fake OpenAI error")
+        text = "Ответ заглушки. " * 20
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+                                completion_tokens=len(text) // 4)
+        if not stream:
+            await asyncio.sleep(total)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+        return FakeStream(self._stream(text, total, usage))
+
+    async def _stream(self, text, total, usage):
+        parts = text.split(" ")
+        step = total / max(len(parts), 1)
+        for part in parts:
+            await asyncio.sleep(step)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part + " "))], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeStream:
+    """Как openai.AsyncStream: асинхронный итератор с close()"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def __aiter__(self):
+        return self._chunks
+
+    async def close(self):
+        await self._chunks.aclose()
+
+
+def snippet(query: str, i: int) -> str:
+    """Разные сниппеты для разных результатов: одинаковые бот склеил бы как перепечатки"""
+    rnd = random.Random(f"{query}/{i}")
+    words = ("".join(rnd.choices("абвгдеклмнопрст", k=6)) for _ in range(25))
+    return f"Про {query}: " + " ".join(words)
+
+
+def make_fake_ddgs(latency: Latency):
+    class FakeDDGS:
+        """Синхронный, как настоящий DDGS: бот вызывает его из пула потоков"""
+
+        def _results(self, query, max_results=5):
+            time.sleep(latency.sample())
+            if latency.fails():
+                raise RuntimeError("Ratelimit")
+            return [
+                {"title": f"{query} — результат {i}", "body": snippet(query, i),
+                 "href": f"https://example{i}.com/{abs(hash(query)) % 1000}"}
+                for i in range(max_results)
+            ]
+
+        text = _results
+        news = _results
+
+        def close(self):
+            pass
+
+    return FakeDDGS
+
+
+# ─── ТРАФИК ─────────────────────────────────────────────────────────
+def make_update(update_id: int, chat_id: int, user_id: int, text: str, reply_to=None) -> dict:
+    chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup", "title": "bench"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": chat,
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"offset": 0, "length": len(command), "type": "bot_command"}]
+    if reply_to is not None:
+        message["reply_to_message"] = reply_to
+    return {"update_id": update_id, "message": message}
+
+
+def make_traffic(args, rnd: random.Random):
+    """Список (path, update_dict, время отправки от начала теста)"""
+    mix = {"search": args.search, "chat": args.chat, "command": args.command, "ignored": args.ignored}
+    paths, weights = zip(*mix.items())
+    queries = [" ".join(rnd.sample(QUERY_WORDS, 3)) for _ in range(args.distinct_queries)]
+    chats = [(-1_000_000_000 - i) if i % 3 else (100_000 + i) for i in range(args.chats)]
+
+    traffic, t = [], 0.0
+    for update_id in range(1, args.updates + 1):
+        t += rnd.expovariate(args.rate)
+        path = rnd.choices(paths, weights)[0]
+        chat_id = rnd.choice(chats)
+        user_id = rnd.randint(1, 5000)
+        group = chat_id < 0
+        address = f"@{BOT_USERNAME} " if group else ""
+        if path == "search":
+            text = f"{address}погугли {rnd.choice(queries)}"
+        elif path == "chat":
+            text = address + " ".join(rnd.sample(CHAT_WORDS, 5))
+        elif path == "command":
+            text = rnd.choice(["/ping", "/style", "/style Ты — уставший сисадмин", "/admin", "/version", "/start"])
+        else:
+            if not group:
+                path, text = "chat", " ".join(rnd.sample(CHAT_WORDS, 5))
+            else:
+                text = " ".join(rnd.sample(CHAT_WORDS + QUERY_WORDS, 8))
+        traffic.append((path, make_update(update_id, chat_id, user_id, text), t))
+        if args.burst_every and update_id % args.burst_every == 0:
+            # всплеск: пачка одинаковых сообщений из того же чата в один момент
+            for extra in range(args.burst_size):
+                traffic.append((path, make_update(args.updates * 10 + update_id * 100 + extra, chat_id, user_id, text), t))
+    return traffic
+
+
+# ─── ПРОГОН ─────────────────────────────────────────────────────────
+def load_bot(path: str):
+    spec = importlib.util.spec_from_file_location("bot_under_test", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+async def run(args) -> dict:
+    from telegram import Update
+    from telegram.ext import SimpleUpdateProcessor
+
+    rnd = random.Random(args.seed)
+    bot = load_bot(args.bot_path)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    elif hasattr(bot, "setup_logging"):
+        bot.setup_logging()  # import bot логирование больше не настраивает
+
+    fake_bot = FakeBot(Latency(args.tg_latency, args.tg_errors, rnd))
+    bot.openai = FakeOpenAI(Latency(args.openai_latency, args.openai_errors, rnd))
+    bot.DDGS = make_fake_ddgs(Latency(args.ddg_latency, args.ddg_errors, random.Random(args.seed + 1)))
+    bot.DDGS_AVAILABLE = True
+    if hasattr(bot, "UPDATES"):
+        bot.UPDATES.start = _noop  # без походов в GitHub
+
+    handlers = {
+        "/start": bot.cmd_start, "/style": bot.cmd_style, "/ping": bot.cmd_ping,
+        "/admin": bot.cmd_admin, "/version": bot.cmd_version,
+    }
+    for name in ("cmd_usage", "cmd_queue", "cmd_profile", "cmd_debounce"):
+        if hasattr(bot, name):
+            handlers["/" + name[4:]] = getattr(bot, name)
+
+    # Старые ревизии обрабатывали апдейты по одному — как PTB по умолчанию
+    if hasattr(bot, "ChatOrderedUpdateProcessor"):
+        processor = bot.ChatOrderedUpdateProcessor(bot.MAX_CONCURRENT_UPDATES)
+    else:
+        processor = SimpleUpdateProcessor(1)
+    await processor.initialize()
+    app = SimpleNamespace(bot=fake_bot, update_processor=processor, update_queue=asyncio.Queue(),
+                          create_task=lambda coroutine, update=None: asyncio.create_task(coroutine))
+    if hasattr(bot, "on_startup"):
+        await bot.on_startup(app)
+
+    traffic = make_traffic(args, rnd)
+    latencies = {}
+    errors = {}
+    lag = []
+    done = asyncio.Event()
+
+    async def monitor():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            t = loop.time()
+            await asyncio.sleep(0.01)
+            lag.append(max(0.0, loop.time() - t - 0.01))
+
+    async def handle(path, update):
+        text = update.message.text
+        ctx = SimpleNamespace(args=text.split()[1:], application=app, bot=fake_bot)
+        if text.startswith("/"):
+            handler = handlers.get(text.split()[0], bot.cmd_ping)
+        else:
+            handler = bot.chat
+        return await handler(update, ctx)
+
+    async def one(path, update):
+        start = time.perf_counter()
+        try:
+            await processor.process_update(update, handle(path, update))
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+        latencies.setdefault(path, []).append(time.perf_counter() - start)
+
+    monitor_task = asyncio.create_task(monitor())
+    started = time.perf_counter()
+    tasks = []
+    for path, data, at in traffic:
+        delay = at - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(path, Update.de_json(data, fake_bot))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await monitor_task
+
+    if hasattr(bot, "on_stop"):
+        await bot.on_stop(app)
+    if hasattr(bot, "on_shutdown"):
+        await bot.on_shutdown(app)
+
+    return {
+        "bot": args.bot_path,
+        "updates": len(traffic),
+        "elapsed": elapsed,
+        "throughput": len(traffic) / elapsed,
+        "paths": {
+            path: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+            for path, values in sorted(latencies.items())
+        },
+        "loop_lag": {"p50": percentile(lag, 50), "p99": percentile(lag, 99), "max": max(lag, default=0.0)},
+        "errors": errors,
+        "upstream": {"openai_calls": bot.openai.calls, "telegram_sends": fake_bot.sent, "telegram_edits": fake_bot.edits},
+    }
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+# ─── ОТЧЁТ ──────────────────────────────────────────────────────────
+def print_report(result: dict):
+    print(f"bot.py:      {result['bot']}")
+    print(f"updates:     {result['updates']} in {result['elapsed']:.2f}s  ->  {result['throughput']:.1f} upd/s")
+    print(f"upstream:    {result['upstream']}")
+    if result["errors"]:
+        print(f"errors:      {result['errors']}")
+    print(f"\n{'path':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for path, s in result["paths"].items():
+        print(f"{path:<10}{s['count']:>8}{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}")
+    lag = result["loop_lag"]
+    print(f"\nevent loop lag: p50 {lag['p50'] * 1000:.1f} ms, p99 {lag['p99'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms")
+
+
+def print_comparison(a: dict, b: dict, rev_a: str, rev_b: str):
+    def delta(x, y):
+        return f"{(y - x) / x * 100:+.0f}%" if x else "n/a"
+
+    print(f"\n{'':<22}{rev_a:>12}{rev_b:>12}{'delta':>9}")
+    print(f"{'throughput upd/s':<22}{a['throughput']:>12.1f}{b['throughput']:>12.1f}{delta(a['throughput'], b['throughput']):>9}")
+    for path in sorted(set(a["paths"]) | set(b["paths"])):
+        for q in ("p50", "p95", "p99"):
+            x = a["paths"].get(path, {}).get(q, 0) * 1000
+            y = b["paths"].get(path, {}).get(q, 0) * 1000
+            print(f"{path + ' ' + q + ' ms':<22}{x:>12.1f}{y:>12.1f}{delta(x, y):>9}")
+    x, y = a["loop_lag"]["p99"] * 1000, b["loop_lag"]["p99"] * 1000
+    print(f"{'loop lag p99 ms':<22}{x:>12.1f}{y:>12.1f}{delta(x, y):>9}")
+
+
+def compare(args, passthrough):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        for rev in args.compare:
+            tree = os.path.join(workdir, rev.replace("/", "_").replace("~", "-").replace("^", "-"))
+            subprocess.run(["git", "-C", REPO, "worktree", "add", "--detach", tree, rev],
+                           check=True, capture_output=True)
+            out = os.path.join(workdir, f"{os.path.basename(tree)}.json")
+            print(f"=== {rev} ===", flush=True)
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--bot-path", os.path.join(tree, "bot.py"),
+                            "--json", out, *passthrough], check=True)
+            with open(out) as f:
+                results[rev] = json.load(f)
+            subprocess.run(["git", "-C", REPO, "worktree", "remove", "--force", tree], capture_output=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        subprocess.run(["git", "-C", REPO, "worktree", "prune"], capture_output=True)
+    rev_a, rev_b = args.compare
+    print_comparison(results[rev_a], results[rev_b], rev_a, rev_b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot-path", default=os.path.join(REPO, "bot.py"))
+    parser.add_argument("--compare", nargs=2, metavar=("REV_A", "REV_B"), help="сравнить две git-ревизии")
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="не глушить INFO-логи бота")
+    traffic = parser.add_argument_group("трафик")
+    traffic.add_argument("--updates", type=int, default=1000)
+    traffic.add_argument("--rate", type=float, default=100.0, help="средний поток апдейтов в секунду")
+    traffic.add_argument("--chats", type=int, default=50)
+    traffic.add_argument("--burst-every", type=int, default=100, help="каждый N-й апдейт — всплеск (0 — без всплесков)")
+    traffic.add_argument("--burst-size", type=int, default=10)
+    traffic.add_argument("--distinct-queries", type=int, default=50)
+    traffic.add_argument("--search", type=float, default=0.2, help="доля поисковых запросов")
+    traffic.add_argument("--chat", type=float, default=0.3, help="доля обращений к боту")
+    traffic.add_argument("--command", type=float, default=0.1, help="доля команд")
+    traffic.add_argument("--ignored", type=float, default=0.4, help="доля групповых сообщений не боту")
+    fakes = parser.add_argument_group("заглушки (задержка в секундах, доля ошибок)")
+    fakes.add_argument("--tg-latency", type=float, default=0.05)
+    fakes.add_argument("--tg-errors", type=float, default=0.0)
+    fakes.add_argument("--openai-latency", type=float, default=1.0)
+    fakes.add_argument("--openai-errors", type=float, default=0.01)
+    fakes.add_argument("--ddg-latency", type=float, default=0.8)
+    fakes.add_argument("--ddg-errors", type=float, default=0.05)
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="оставить лимиты Telegram на отправку (по умолчанию сняты, чтобы мерить код)")
+    args, _ = parser.parse_known_args()
+
+    if args.compare:
+        passthrough = [a for a in sys.argv[1:] if a not in args.compare and a != "--compare"]
+        return compare(args, passthrough)
+
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "0:bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["BOT_USERNAME"] = BOT_USERNAME
+    statedir = tempfile.mkdtemp(prefix="loadtest-state-")
+    os.environ["STATE_DB"] = os.path.join(statedir, "state.db")
+    if not args.telegram_limits:
+        for name in ("TG_GLOBAL_RATE", "TG_CHAT_RATE", "TG_GROUP_RATE"):
+            os.environ.setdefault(name, "100000")
+    os.environ.setdefault("SEARCH_MIN_INTERVAL", "0")
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(statedir, ignore_errors=True)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,286 +2,2965 @@
 import os
 import re
 import logging
+import atexit
 import json
-from typing import Optional
+import hmac
+import hashlib
+import secrets
+import signal
+import sqlite3
+import time
+STARTED_AT = time.perf_counter()  # для разбивки времени запуска (StartupTimer)
+import zlib
+import bisect
+import queue
+import random
+import asyncio
+import functools
+import importlib.util
+import contextvars
+from collections import OrderedDict, deque
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+
+def load_env():
+    """Загружает переменные окружения из .env файла"""
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        # Если python-dotenv не установлен, пытаемся загрузить .env вручную
+        env_file = os.path.join(os.path.dirname(__file__), '.env')
+        if os.path.exists(env_file):
+            with open(env_file, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#') and '=' in line:
+                        key, value = line.split('=', 1)
+                        os.environ[key] = value
+
+
+# .env читаем только при запуске скрипта (до чтения конфига ниже): import bot не трогает окружение.
+# Воркеры BOT_WORKERS получают уже загруженное окружение от главного процесса
+if __name__ == "__main__":
+    load_env()
+
+from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import (
+    ApplicationBuilder, BaseUpdateProcessor, MessageHandler, CommandHandler,
+    ContextTypes, filters
+)
+# Импортируем ddgs для поиска
+try:
+    from ddgs import DDGS
+    DDGS_AVAILABLE = True
+except ImportError:
+    DDGS_AVAILABLE = None
+# NumPy нужен только индексу похожих запросов; без него работает обычный кэш.
+# Сам импорт — при первом поиске, чтобы не тормозить старт
+NUMPY_AVAILABLE = True if importlib.util.find_spec("numpy") else None
+np = None
+
+# ─── ЛОГИ ───────────────────────────────────────────────────────────
+LOG_LEVEL      = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT     = os.getenv("LOG_FORMAT", "text").lower()   # text | json
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # сколько строк ждут записи; лишние отбрасываются
+LOG_SAMPLE     = os.getenv("LOG_SAMPLE", "")                # категория=доля INFO-строк, которую пишем: "search=0.1"
+LOG_RATE_LIMIT = os.getenv("LOG_RATE_LIMIT", "search=120,updates=10,httpx=30")  # категория=строк в минуту
+LOG_TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(message)s"
+
+log        = logging.getLogger("mrazz-bot")
+search_log = log.getChild("search")   # поисковые запросы и бэкенды DDGS
+update_log = log.getChild("updates")  # версия и проверка обновлений
+send_log   = log.getChild("send")     # очередь исходящих сообщений
+LOG_LISTENER = None
+
+
+def parse_log_categories(spec: str) -> dict:
+    """"search=0.1,updates=5" -> {"search": 0.1, "updates": 5.0}"""
+    categories = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            categories[name.strip()] = float(value)
+    return categories
+
+
+def log_category(record: logging.LogRecord) -> str:
+    """Категория строки: дочерний логгер бота (search, updates, ...) или пакет (httpx, telegram)"""
+    if record.name.startswith(log.name + "."):
+        return record.name[len(log.name) + 1:]
+    return record.name.partition(".")[0]
+
+
+class LogSampler(logging.Filter):
+    """Сэмплирование и лимит строк в минуту по категориям; WARNING и выше проходят всегда.
+
+    Отброшенные строки считаются в bot_log_dropped_total, а первая прошедшая после них
+    строка категории несёт их число в поле suppressed.
+    """
+
+    def __init__(self, sample: dict, rate_limits: dict):
+        super().__init__()
+        self.sample = sample
+        self.rate_limits = rate_limits
+        self._windows = {}     # категория -> [начало минуты, строк в ней]
+        self._suppressed = {}  # категория -> сколько строк отброшено с последней записанной
+
+    def _drop(self, category: str, reason: str) -> bool:
+        self._suppressed[category] = self._suppressed.get(category, 0) + 1
+        LOG_DROPPED.inc(category=category, reason=reason)
+        return False
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        category = log_category(record)
+        share = self.sample.get(category)
+        if share is not None and random.random() >= share:
+            return self._drop(category, "sampled")
+        limit = self.rate_limits.get(category)
+        if limit is not None:
+            now = time.monotonic()
+            window = self._windows.setdefault(category, [now, 0])
+            if now - window[0] >= 60:
+                window[0], window[1] = now, 0
+            if window[1] >= limit:
+                return self._drop(category, "rate_limited")
+            window[1] += 1
+        suppressed = self._suppressed.pop(category, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование и запись — в потоке листенера.
+
+    Очередь ограничена: если вывод не успевает, новые строки отбрасываются, а не копятся
+    в памяти и не тормозят event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # очередь внутри процесса — копировать и форматировать заранее незачем
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc(category=log_category(record), reason="queue_full")
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (+{suppressed} пропущено)" if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись — для journald, Docker и сборщиков логов"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.processName != "MainProcess":
+            entry["process"] = record.processName
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """Логи через очередь: в хэндлерах только put_nowait, в stderr пишет отдельный поток.
+
+    Вызывается из main() и в каждом воркере; import bot логирование не настраивает.
+    """
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(LOG_TEXT_FORMAT))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(LogSampler(parse_log_categories(LOG_SAMPLE), parse_log_categories(LOG_RATE_LIMIT)))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    LOG_LISTENER = QueueListener(log_queue, output)
+    LOG_LISTENER.start()
+    atexit.register(LOG_LISTENER.stop)  # дописывает очередь до logging.shutdown()
+
+# ─── КОНФИГ ─────────────────────────────────────────────────────────
+TG_TOKEN     = os.getenv("TELEGRAM_BOT_TOKEN")
+OPENAI_KEY   = os.getenv("OPENAI_API_KEY")
+BOT_USERNAME = os.getenv("BOT_USERNAME", "").lstrip("@")
+
+# Клиент OpenAI создаётся при первом запросе (или в фоне после старта): импорт SDK —
+# самая долгая часть запуска, а /ping он не нужен
+openai = None
+
+
+def openai_client():
+    global openai
+    if openai is None:
+        from openai import AsyncOpenAI
+        openai = AsyncOpenAI(api_key=OPENAI_KEY, max_retries=0)  # повторы и таймауты — в OPENAI_GUARD
+    return openai
+
+# Персона бота по умолчанию (нейтральная)
+DEFAULT_STYLE = (
+    "Ты — полезный и дружелюбный ИИ-ассистент. "
+    "Отвечай вежливо, информативно и по делу. "
+    "Можешь использовать юмор, но оставайся уважительным. "
+    "Краткость приветствуется, но давай полные ответы."
+)
+
+# Система администраторов
+ADMIN_IDS = set()  # Множество ID администраторов
+SUPER_ADMIN_ID = None  # ID супер-администратора (первый пользователь)
+
+STYLES = {}  # chat_id -> system prompt (кэш в памяти, хранится в STATE_DB)
+CHAT_SETTINGS = {}  # chat_id -> {настройка: значение}, например {"debounce": "1.5"}
+
+# ─── ХРАНИЛИЩЕ СОСТОЯНИЯ ────────────────────────────────────────────
+BASE_DIR             = os.path.dirname(os.path.abspath(__file__))
+STATE_DB             = os.getenv("STATE_DB", os.path.join(BASE_DIR, "logs", "state.db"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))  # как часто сбрасывать изменения, сек
+
+# Старый файл администраторов: импортируется в STATE_DB при первом запуске
+ADMINS_FILE = "/opt/not-your-mama-bot/logs/admins.json"
+
+
+class StateStore:
+    """SQLite в режиме WAL за кэшем в памяти: читаем из dict, пишем пачками в фоновом потоке"""
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Один поток — один писатель: запросы к SQLite не пересекаются и не блокируют loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._conn = None
+        self._dirty_styles = {}    # chat_id -> стиль (None — удалить)
+        self._dirty_settings = {}  # (chat_id, настройка) -> значение (None — удалить)
+        self._dirty_admins = {}    # user_id -> True (добавить) / None (удалить)
+        self._dirty_meta = {}      # ключ -> значение (JSON-совместимое)
+        self._data_version = None  # PRAGMA data_version: меняется, когда базу пишет другой процесс
+        self._loaded = None        # asyncio.Event: состояние прочитано (или прочитать не вышло)
+        self._task = None
+
+    # --- работа с SQLite (только в потоке self._executor) ---
+
+    def _open(self):
+        if self._conn is not None:
+            return self._conn
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS styles (chat_id INTEGER PRIMARY KEY, style TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chat_settings (
+                chat_id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (chat_id, key)
+            );
+            CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY, is_super INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS backlog (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL);
+        """)
+        self._conn = conn
+        return conn
+
+    def _load_sync(self):
+        conn = self._open()
+        styles = dict(conn.execute("SELECT chat_id, style FROM styles"))
+        settings = {}
+        for chat_id, key, value in conn.execute("SELECT chat_id, key, value FROM chat_settings"):
+            settings.setdefault(chat_id, {})[key] = value
+        admins = conn.execute("SELECT user_id, is_super FROM admins").fetchall()
+        if not admins and os.path.exists(ADMINS_FILE):
+            admins = self._import_admins_file(conn)
+        admin_ids = {user_id for user_id, _ in admins}
+        super_admin_id = next((user_id for user_id, is_super in admins if is_super), None)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'update_snapshot'").fetchone()
+        updates = json.loads(row[0]) if row else None
+        self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return styles, settings, admin_ids, super_admin_id, updates
+
+    def _changed_sync(self) -> bool:
+        version = self._open().execute("PRAGMA data_version").fetchone()[0]
+        return self._data_version is not None and version != self._data_version
+
+    @staticmethod
+    def _import_admins_file(conn):
+        try:
+            with open(ADMINS_FILE, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            log.warning("Ошибка загрузки администраторов: %s", e)
+            return []
+        super_admin_id = data.get('super_admin_id')
+        admins = [(user_id, int(user_id == super_admin_id)) for user_id in data.get('admin_ids', [])]
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO admins VALUES (?, ?)", admins)
+        log.info("Импортировано %d администраторов из %s", len(admins), ADMINS_FILE)
+        return admins
+
+    def _write_sync(self, styles: dict, settings: dict, admins: dict, meta: dict):
+        conn = self._open()
+        with conn:  # одна транзакция: либо всё, либо ничего
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in meta.items()]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO styles VALUES (?, ?)",
+                [(chat_id, style) for chat_id, style in styles.items() if style is not None]
+            )
+            conn.executemany(
+                "DELETE FROM styles WHERE chat_id = ?",
+                [(chat_id,) for chat_id, style in styles.items() if style is None]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_settings VALUES (?, ?, ?)",
+                [(chat_id, key, value) for (chat_id, key), value in settings.items() if value is not None]
+            )
+            conn.executemany(
+                "DELETE FROM chat_settings WHERE chat_id = ? AND key = ?",
+                [key for key, value in settings.items() if value is None]
+            )
+            # Построчно, как стили: у каждого воркера свои изменения, чужие не затираем.
+            # is_super не трогаем — его ставит только claim_super_admin
+            conn.executemany(
+                "INSERT OR IGNORE INTO admins (user_id) VALUES (?)",
+                [(user_id,) for user_id, added in admins.items() if added]
+            )
+            conn.executemany(
+                "DELETE FROM admins WHERE user_id = ? AND is_super = 0",
+                [(user_id,) for user_id, added in admins.items() if not added]
+            )
+
+    def _claim_super_admin_sync(self, user_id: int) -> int:
+        conn = self._open()
+        with conn:
+            # Условная вставка: из нескольких воркеров, одновременно получивших
+            # первый /start, супер-админом станет только один
+            conn.execute(
+                "INSERT INTO admins (user_id, is_super) SELECT ?, 1"
+                " WHERE NOT EXISTS (SELECT 1 FROM admins WHERE is_super = 1)"
+                " ON CONFLICT (user_id) DO UPDATE SET is_super = 1",
+                (user_id,)
+            )
+            return conn.execute("SELECT user_id FROM admins WHERE is_super = 1").fetchone()[0]
+
+    def _save_backlog_sync(self, payloads: List[dict]):
+        conn = self._open()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO backlog VALUES (?, ?)",
+                [(data["update_id"], json.dumps(data, ensure_ascii=False)) for data in payloads]
+            )
+
+    def _take_backlog_sync(self):
+        conn = self._open()
+        with conn:
+            meta = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+            payloads = [json.loads(row[0]) for row in conn.execute("SELECT payload FROM backlog ORDER BY update_id")]
+            conn.execute("DELETE FROM backlog")
+            conn.execute("DELETE FROM meta WHERE key = 'last_drain'")  # отчёт об остановке читаем один раз
+        return meta, payloads
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # --- интерфейс для event loop ---
+
+    async def _in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def load(self):
+        """Читает состояние из базы в глобальные кэши STYLES / CHAT_SETTINGS / ADMIN_IDS / SUPER_ADMIN_ID"""
+        global SUPER_ADMIN_ID
+        start = time.perf_counter()
+        try:
+            styles, settings, admin_ids, super_admin_id, updates = await self._in_thread(self._load_sync)
+        except Exception as e:
+            log.warning("Ошибка загрузки состояния из %s: %s", self.path, e)
+            return
+        finally:
+            self._loaded_event().set()
+        if updates:
+            UPDATES.follow(updates)
+        STYLES.update(styles)
+        CHAT_SETTINGS.update(settings)
+        ADMIN_IDS.update(admin_ids)
+        if SUPER_ADMIN_ID is None:
+            SUPER_ADMIN_ID = super_admin_id
+        log.info("Загружено %d администраторов и %d стилей за %.2fs",
+                 len(ADMIN_IDS), len(STYLES), time.perf_counter() - start)
+
+    def _loaded_event(self) -> asyncio.Event:
+        if self._loaded is None:
+            self._loaded = asyncio.Event()
+        return self._loaded
+
+    async def wait_loaded(self):
+        """Ждёт первой загрузки состояния: до неё нельзя ни проверять админов, ни брать стиль"""
+        await self._loaded_event().wait()
+
+    async def refresh(self):
+        """Перечитывает базу, если её изменил другой процесс (воркеры в режиме BOT_WORKERS > 1)"""
+        global SUPER_ADMIN_ID
+        try:
+            if not await self._in_thread(self._changed_sync):
+                return
+            styles, settings, admin_ids, super_admin_id, updates = await self._in_thread(self._load_sync)
+        except Exception as e:
+            log.warning("Ошибка перечитывания состояния из %s: %s", self.path, e)
+            return
+        if updates:
+            UPDATES.follow(updates)
+        # Кэши собираем заново из снимка базы, чтобы удалённое другим процессом исчезло и здесь;
+        # свои ещё не записанные изменения важнее прочитанного
+        for chat_id, style in self._dirty_styles.items():
+            styles.pop(chat_id, None)
+            if style is not None:
+                styles[chat_id] = style
+        for (chat_id, key), value in self._dirty_settings.items():
+            values = settings.setdefault(chat_id, {})
+            values.pop(key, None)
+            if value is not None:
+                values[key] = value
+        for user_id, added in self._dirty_admins.items():
+            if added:
+                admin_ids.add(user_id)
+            elif user_id != super_admin_id:
+                admin_ids.discard(user_id)
+        STYLES.clear()
+        STYLES.update(styles)
+        CHAT_SETTINGS.clear()
+        CHAT_SETTINGS.update((chat_id, values) for chat_id, values in settings.items() if values)
+        ADMIN_IDS.clear()
+        ADMIN_IDS.update(admin_ids)
+        SUPER_ADMIN_ID = super_admin_id
+        log.info("Состояние перечитано: %d администраторов, %d стилей", len(ADMIN_IDS), len(STYLES))
+
+    def set_style(self, chat_id: int, style: Optional[str]):
+        if style is None:
+            STYLES.pop(chat_id, None)
+        else:
+            STYLES[chat_id] = style
+        self._dirty_styles[chat_id] = style
+
+    def set_setting(self, chat_id: int, key: str, value: Optional[str]):
+        if value is None:
+            CHAT_SETTINGS.get(chat_id, {}).pop(key, None)
+        else:
+            CHAT_SETTINGS.setdefault(chat_id, {})[key] = value
+        self._dirty_settings[(chat_id, key)] = value
+
+    def set_admin(self, user_id: int, is_admin: bool):
+        if is_admin:
+            ADMIN_IDS.add(user_id)
+        else:
+            ADMIN_IDS.discard(user_id)
+        self._dirty_admins[user_id] = True if is_admin else None
+
+    async def claim_super_admin(self, user_id: int) -> int:
+        """Назначает user_id супер-администратором, если его ещё нет; возвращает действующего"""
+        global SUPER_ADMIN_ID
+        try:
+            SUPER_ADMIN_ID = await self._in_thread(self._claim_super_admin_sync, user_id)
+        except Exception as e:
+            log.warning("Ошибка назначения супер-администратора в %s: %s", self.path, e)
+            if SUPER_ADMIN_ID is None:
+                SUPER_ADMIN_ID = user_id
+                self.set_admin(user_id, True)
+        ADMIN_IDS.add(SUPER_ADMIN_ID)
+        return SUPER_ADMIN_ID
+
+    def set_meta(self, key: str, value):
+        self._dirty_meta[key] = value
+
+    async def save_backlog(self, payloads: List[dict]):
+        """Сохраняет необработанные апдейты (Update.to_dict()) до следующего запуска"""
+        if not payloads:
+            return
+        try:
+            await self._in_thread(self._save_backlog_sync, payloads)
+        except Exception as e:
+            log.warning("Не удалось сохранить %d отложенных апдейтов: %s", len(payloads), e)
+
+    async def take_backlog(self):
+        """Забирает сохранённые апдейты и служебные записи meta: (meta, [Update.to_dict()])"""
+        return await self._in_thread(self._take_backlog_sync)
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if not (self._dirty_styles or self._dirty_settings or self._dirty_admins or self._dirty_meta):
+            return
+        styles, self._dirty_styles = self._dirty_styles, {}
+        settings, self._dirty_settings = self._dirty_settings, {}
+        meta, self._dirty_meta = self._dirty_meta, {}
+        admins, self._dirty_admins = self._dirty_admins, {}
+        try:
+            await self._in_thread(self._write_sync, styles, settings, admins, meta)
+        except Exception as e:
+            log.warning("Ошибка сохранения состояния: %s", e)
+            # Не теряем изменения: вернём их в очередь, если поверх не записали новые
+            for chat_id, style in styles.items():
+                self._dirty_styles.setdefault(chat_id, style)
+            for key, value in settings.items():
+                self._dirty_settings.setdefault(key, value)
+            for key, value in meta.items():
+                self._dirty_meta.setdefault(key, value)
+            for user_id, added in admins.items():
+                self._dirty_admins.setdefault(user_id, added)
+
+    async def start(self):
+        """Загружает состояние в фоне (бот уже принимает апдейты) и запускает периодическую запись"""
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        await self.load()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            await self.refresh()
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        await self._in_thread(self._close_sync)
+        self._executor.shutdown(wait=True)
+
+
+STORE = StateStore(STATE_DB, STATE_FLUSH_INTERVAL)
+
+
+def needs_state(handler):
+    """Хэндлер, которому нужны админы, стили или настройки чатов, ждёт их загрузки из STORE"""
+    @functools.wraps(handler)
+    async def wrapper(update, ctx):
+        await STORE.wait_loaded()
+        return await handler(update, ctx)
+    return wrapper
+
+
+MAX_CHUNK = 4000  # предел для сообщений телеги (~4096)
+
+# ─── МЕТРИКИ ────────────────────────────────────────────────────────
+METRICS_PORT   = int(os.getenv("METRICS_PORT", "0"))          # 0 — отдельный сервер метрик не поднимаем
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels_text(names, values, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_labels_text(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение снимается функцией в момент отдачи метрик — на горячем пути ничего не делаем"""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn: Callable[[], float], labels=()):
+        super().__init__(name, help_text, labels)
+        self.fn = fn  # с labels возвращает {значение метки (или кортеж): число}
+
+    def render(self) -> List[str]:
+        try:
+            if not self.labels:
+                return [f"{self.name} {self.fn()}"]
+            return [
+                f"{self.name}{_labels_text(self.labels, k if isinstance(k, tuple) else (k,))} {v}"
+                for k, v in self.fn().items()
+            ]
+        except Exception:
+            return []
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [счётчики по бакетам..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):  # больше последней границы — попадёт только в +Inf
+            row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, row in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, le)} {row[-1]}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {row[-2]}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {row[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Минимальный реестр метрик в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, fn, labels=()) -> Gauge:
+        return self._register(Gauge(name, help_text, fn, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+STAGE_LATENCY  = METRICS.histogram("bot_stage_seconds", "Latency of chat() stages", ("stage",))
+OPENAI_LATENCY = METRICS.histogram("bot_openai_request_seconds", "OpenAI request latency", ("model", "kind"))
+OPENAI_TOKENS  = METRICS.counter("bot_openai_tokens_total", "OpenAI tokens used", ("model", "type"))
+MESSAGES       = METRICS.counter("bot_messages_total", "Text messages seen by chat()", ("outcome",))
+ERRORS         = METRICS.counter("bot_errors_total", "Errors by stage and exception type", ("stage", "type"))
+CACHE_EVENTS   = METRICS.counter("bot_cache_events_total", "Search and summary cache lookups", ("cache", "event"))
+LOG_DROPPED    = METRICS.counter("bot_log_dropped_total", "Log lines dropped by sampling, rate limits or a full queue", ("category", "reason"))
+
+
+def count_error(stage: str, error: BaseException):
+    ERRORS.inc(stage=stage, type=type(error).__name__)
+
+# ─── УТИЛИТЫ ────────────────────────────────────────────────────────
+def chunk_text(s: str, n: int = MAX_CHUNK):
+    return (s[i:i+n] for i in range(0, len(s), n))
+
+# ─── ИСХОДЯЩИЕ СООБЩЕНИЯ ────────────────────────────────────────────
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # сообщений в секунду на всего бота
+TG_CHAT_RATE   = float(os.getenv("TG_CHAT_RATE", "1"))     # сообщений в секунду в личный чат
+TG_GROUP_RATE  = float(os.getenv("TG_GROUP_RATE", "20"))   # сообщений в минуту в группу
+SEND_WORKERS   = int(os.getenv("SEND_WORKERS", "8"))       # сколько чатов обслуживается параллельно
+SEND_RETRIES   = int(os.getenv("SEND_RETRIES", "5"))       # повторов при сетевых ошибках
+COALESCE_LIMIT = 500  # сообщения короче этого склеиваются с соседними в одно
+
+
+class TokenBucket:
+    """Token bucket с резервированием: reserve() сразу говорит, сколько ждать своей очереди"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1  # уходим в минус: следующие будут ждать дольше, порядок сохраняется
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self) -> bool:
+        """Неблокирующий вариант: берёт токен, если он есть"""
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def block(self, seconds: float):
+        """Флуд-контроль от Telegram: ничего не отправлять ближайшие seconds секунд"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class _OutboundJob:
+    __slots__ = ("kind", "chat_id", "text", "reply_to", "message_id", "coalesce", "future")
+
+    def __init__(self, kind, chat_id, text, reply_to=None, message_id=None, coalesce=True):
+        self.kind = kind  # "send" | "edit"
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_to = reply_to
+        self.message_id = message_id
+        self.coalesce = coalesce
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class OutboundQueue:
+    """Единая очередь исходящих сообщений с лимитами Telegram, ретраями и склейкой"""
+
+    def __init__(self, workers: int = SEND_WORKERS, retries: int = SEND_RETRIES):
+        self.workers = workers
+        self.retries = retries
+        self.bot = None
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._buckets = {}   # chat_id -> TokenBucket
+        self._chats = {}     # chat_id -> deque неотправленных задач; чат здесь, пока ему есть что слать
+        self._ready = None   # очередь чатов, готовых к отправке
+        self._tasks = []
+
+    @property
+    def depth(self) -> int:
+        return sum(len(q) for q in self._chats.values())
+
+    def start(self, bot):
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Досылает то, что уже в очереди, и останавливает воркеров"""
+        deadline = time.monotonic() + timeout
+        while self._chats and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, chat_id: int, text: str, reply_to: Optional[int] = None,
+             coalesce: bool = True) -> asyncio.Future:
+        """Ставит сообщение в очередь; coalesce=False — если его потом будут редактировать"""
+        return self._submit(_OutboundJob("send", chat_id, text, reply_to=reply_to, coalesce=coalesce))
+
+    def edit(self, chat_id: int, message_id: int, text: str) -> asyncio.Future:
+        pending = self._chats.get(chat_id, ())
+        for job in pending:
+            # Ещё не отправленное редактирование того же сообщения просто получает новый текст
+            if job.kind == "edit" and job.message_id == message_id:
+                job.text = text
+                return job.future
+        return self._submit(_OutboundJob("edit", chat_id, text, message_id=message_id))
+
+    def _submit(self, job: _OutboundJob) -> asyncio.Future:
+        pending = self._chats.get(job.chat_id)
+        if pending is None:
+            pending = self._chats[job.chat_id] = deque()
+            self._ready.put_nowait(job.chat_id)
+        pending.append(job)
+        return job.future
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 4096:
+                for cid in [c for c, b in self._buckets.items() if c not in self._chats and b.idle()]:
+                    del self._buckets[cid]
+            # В группах (id < 0) лимит поминутный, в личке — посекундный
+            rate = TG_GROUP_RATE / 60 if chat_id < 0 else TG_CHAT_RATE
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 3)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            pending = self._chats[chat_id]
+            batch = [pending.popleft()]
+            if batch[0].kind == "send" and batch[0].coalesce:
+                # Склеиваем подряд идущие короткие сообщения в тот же чат и на тот же reply
+                size = len(batch[0].text)
+                while (pending and pending[0].kind == "send" and pending[0].coalesce
+                       and pending[0].reply_to == batch[0].reply_to
+                       and len(pending[0].text) < COALESCE_LIMIT and size < COALESCE_LIMIT
+                       and size + 1 + len(pending[0].text) <= MAX_CHUNK):
+                    size += 1 + len(pending[0].text)
+                    batch.append(pending.popleft())
+            try:
+                await self._deliver(chat_id, batch)
+            except Exception as e:
+                send_log.error("Outbound worker error: %r", e)
+            if pending:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def _deliver(self, chat_id: int, batch: List[_OutboundJob]):
+        job = batch[0]
+        text = "\n".join(j.text for j in batch)
+        bucket = self._bucket(chat_id)
+        attempt = 0
+        while True:
+            await asyncio.sleep(bucket.reserve())
+            await asyncio.sleep(self._global.reserve())
+            try:
+                if job.kind == "send":
+                    result = await self.bot.send_message(chat_id, text, reply_to_message_id=job.reply_to)
+                else:
+                    result = await self.bot.edit_message_text(text, chat_id=chat_id, message_id=job.message_id)
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                send_log.warning("Flood control in chat %s, retry in %ss", chat_id, delay)
+                bucket.block(delay)
+                continue
+            except BadRequest as e:
+                if job.kind == "edit" and "not modified" in str(e).lower():
+                    result = None
+                else:
+                    return self._fail(batch, e)
+            except NetworkError as e:
+                attempt += 1
+                if attempt > self.retries:
+                    return self._fail(batch, e)
+                delay = min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+                send_log.warning("Send to chat %s failed (%s), retry %d in %.1fs", chat_id, e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                return self._fail(batch, e)
+            for j in batch:
+                if not j.future.done():
+                    j.future.set_result(result)
+            return
+
+    @staticmethod
+    def _fail(batch: List[_OutboundJob], error: Exception):
+        count_error("send", error)
+        send_log.error("Failed to deliver message to chat %s: %s", batch[0].chat_id, error)
+        for j in batch:
+            if not j.future.done():
+                j.future.set_exception(error)
+
+
+OUTBOX = OutboundQueue()
+METRICS.gauge("bot_outbound_queue_depth", "Messages waiting in the outbound queue", lambda: OUTBOX.depth)
+
+
+def _consume_result(fut: asyncio.Future):
+    if not fut.cancelled():
+        fut.exception()
+
+
+async def send_reply(msg, text: str, quote: bool = True):
+    """Отправляет ответ частями через очередь исходящих; возвращает последнее сообщение"""
+    reply_to = msg.message_id if quote else None
+    futures = [OUTBOX.send(msg.chat_id, ch, reply_to) for ch in chunk_text(text)]
+    with STAGE_LATENCY.time(stage="send"):
+        results = await asyncio.gather(*futures)
+    return results[-1] if results else None
+
+
+async def answer(msg, text: str):
+    """Ответ на команду: в группах — реплаем, в личке — обычным сообщением"""
+    return await send_reply(msg, text, quote=msg.chat.type != "private")
+
+# ─── УЧЁТ ТОКЕНОВ И ЛИМИТЫ ──────────────────────────────────────────
+QUOTA_WINDOW        = float(os.getenv("QUOTA_WINDOW", "3600"))       # окно квот токенов, сек
+USER_TOKEN_QUOTA    = int(os.getenv("USER_TOKEN_QUOTA", "0"))        # токенов OpenAI на пользователя за окно; 0 — без лимита
+CHAT_TOKEN_QUOTA    = int(os.getenv("CHAT_TOKEN_QUOTA", "0"))        # токенов OpenAI на чат за окно; 0 — без лимита
+USER_RATE_PER_MIN   = float(os.getenv("USER_RATE_PER_MIN", "10"))    # запросов к боту в минуту от пользователя; 0 — без лимита
+CHAT_RATE_PER_MIN   = float(os.getenv("CHAT_RATE_PER_MIN", "30"))    # запросов к боту в минуту из чата; 0 — без лимита
+RATE_BURST          = float(os.getenv("RATE_BURST", "5"))            # сколько запросов можно сделать подряд
+USAGE_MAX_ACCOUNTS  = int(os.getenv("USAGE_MAX_ACCOUNTS", "10000"))  # сколько чатов и пользователей помнить
+LIMIT_NOTICE_EVERY  = 60                                             # не чаще раза в минуту говорим «слишком часто»
+
+# Кто сейчас тратит токены: выставляется в chat(), читается в record_usage()
+USAGE_OWNER = contextvars.ContextVar("usage_owner", default=None)
+
+LIMIT_REPLIES = {
+    "rate":  "⏳ Слишком часто. Подождите немного и повторите.",
+    "quota": "⏳ Лимит запросов исчерпан. Попробуйте позже.",
+}
+
+LIMITED = METRICS.counter("bot_limited_total", "Requests rejected by admission control", ("scope", "reason"))
+
+
+class SlidingWindow:
+    """Сумма за последние window секунд: корзины по window/slots, O(1) амортизированно"""
+
+    __slots__ = ("step", "count", "slots", "total")
+
+    def __init__(self, window: float, count: int = 60):
+        self.step = window / count
+        self.count = count
+        self.slots = deque()  # [номер корзины, сумма]
+        self.total = 0
+
+    def _expire(self, now: float):
+        oldest = int(now / self.step) - self.count + 1
+        while self.slots and self.slots[0][0] < oldest:
+            self.total -= self.slots.popleft()[1]
+
+    def add(self, amount: int, now: float):
+        self._expire(now)
+        slot = int(now / self.step)
+        if self.slots and self.slots[-1][0] == slot:
+            self.slots[-1][1] += amount
+        else:
+            self.slots.append([slot, amount])
+        self.total += amount
+
+    def value(self, now: float) -> int:
+        self._expire(now)
+        return self.total
+
+
+class _Account:
+    __slots__ = ("window", "bucket", "prompt", "completion", "requests", "limited", "noticed_at")
+
+    def __init__(self, rate_per_min: float):
+        self.window = SlidingWindow(QUOTA_WINDOW)
+        self.bucket = TokenBucket(rate_per_min / 60, RATE_BURST) if rate_per_min > 0 else None
+        self.prompt = 0           # всего с запуска
+        self.completion = 0
+        self.requests = 0
+        self.limited = 0
+        self.noticed_at = 0.0
+
+
+class UsageLedger:
+    """Учёт токенов OpenAI по чатам и пользователям и допуск запросов до похода в апстрим"""
+
+    def __init__(self, max_accounts: int = USAGE_MAX_ACCOUNTS):
+        self.max_accounts = max_accounts
+        self._accounts = OrderedDict()  # ("chat" | "user", id) -> _Account, LRU
+
+    def _account(self, scope: str, key: int) -> _Account:
+        account = self._accounts.get((scope, key))
+        if account is None:
+            account = _Account(CHAT_RATE_PER_MIN if scope == "chat" else USER_RATE_PER_MIN)
+            self._accounts[(scope, key)] = account
+            if len(self._accounts) > self.max_accounts:
+                self._accounts.popitem(last=False)
+        else:
+            self._accounts.move_to_end((scope, key))
+        return account
+
+    def admit(self, chat_id: int, user_id: int) -> Optional[str]:
+        """None — можно идти в OpenAI; иначе причина отказа (quota | rate)"""
+        now = time.monotonic()
+        checks = (("chat", chat_id, CHAT_TOKEN_QUOTA), ("user", user_id, USER_TOKEN_QUOTA))
+        accounts = [(scope, self._account(scope, key), quota) for scope, key, quota in checks]
+        # Сначала квоты: отказ по ним не должен съедать токены из ведер
+        for scope, account, quota in accounts:
+            if quota and account.window.value(now) >= quota:
+                return self._deny(scope, account, "quota")
+        taken = []
+        for scope, account, _ in accounts:
+            if account.bucket is not None:
+                if not account.bucket.take():
+                    for bucket in taken:
+                        bucket.tokens += 1  # отказ — не повод тратить лимит другого ведра
+                    return self._deny(scope, account, "rate")
+                taken.append(account.bucket)
+        for _, account, _ in accounts:
+            account.requests += 1
+        return None
+
+    @staticmethod
+    def _deny(scope: str, account: _Account, reason: str) -> str:
+        account.limited += 1
+        LIMITED.inc(scope=scope, reason=reason)
+        return reason
+
+    def should_notice(self, chat_id: int) -> bool:
+        """Говорить ли об отказе: не чаще раза в LIMIT_NOTICE_EVERY на чат, чтобы не спамить в ответ на спам"""
+        account = self._account("chat", chat_id)
+        now = time.monotonic()
+        if now - account.noticed_at < LIMIT_NOTICE_EVERY:
+            return False
+        account.noticed_at = now
+        return True
+
+    def record(self, owner, usage):
+        chat_id, user_id = owner
+        now = time.monotonic()
+        prompt = usage.prompt_tokens or 0
+        completion = usage.completion_tokens or 0
+        for scope, key in (("chat", chat_id), ("user", user_id)):
+            account = self._account(scope, key)
+            account.prompt += prompt
+            account.completion += completion
+            account.window.add(prompt + completion, now)
+
+    def top(self, scope: str, n: int = 10) -> list:
+        """[(id, токенов за окно, _Account)] — самые прожорливые за QUOTA_WINDOW"""
+        now = time.monotonic()
+        rows = [
+            (key, account.window.value(now), account)
+            for (s, key), account in self._accounts.items() if s == scope
+        ]
+        rows.sort(key=lambda row: (row[1], row[2].requests), reverse=True)
+        return rows[:n]
+
+
+LEDGER = UsageLedger()
+
+# ─── OPENAI ─────────────────────────────────────────────────────────
+def record_usage(model: str, usage):
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(usage.prompt_tokens or 0, model=model, type="prompt")
+    OPENAI_TOKENS.inc(usage.completion_tokens or 0, model=model, type="completion")
+    owner = USAGE_OWNER.get()
+    if owner is not None:
+        LEDGER.record(owner, usage)
+
+
+OPENAI_TIMEOUT          = float(os.getenv("OPENAI_TIMEOUT", "30"))        # дедлайн на запрос вместе с повторами, сек
+OPENAI_HEDGE_AFTER      = float(os.getenv("OPENAI_HEDGE_AFTER", "8"))     # через сколько секунд дублировать медленный запрос; 0 — не дублировать
+OPENAI_ATTEMPTS         = int(os.getenv("OPENAI_ATTEMPTS", "2"))          # всего попыток на модель (дубли + повторы)
+OPENAI_MAX_CONCURRENCY  = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))  # потолок адаптивного лимита
+OPENAI_MIN_CONCURRENCY  = int(os.getenv("OPENAI_MIN_CONCURRENCY", "2"))
+OPENAI_MAX_QUEUE        = int(os.getenv("OPENAI_MAX_QUEUE", "64"))        # сколько запросов может ждать слота
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))  # подряд неудач до размыкания
+OPENAI_BREAKER_COOLDOWN = float(os.getenv("OPENAI_BREAKER_COOLDOWN", "30"))
+OPENAI_FALLBACK_MODEL   = os.getenv("OPENAI_FALLBACK_MODEL", "")          # запасная модель; пусто — без неё
+
+OPENAI_EVENTS = METRICS.counter("bot_openai_events_total", "Resilience events around OpenAI calls", ("model", "event"))
+
+
+class OpenAIUnavailable(Exception):
+    """OpenAI сейчас не принимает запросы: цепь разомкнута или очередь переполнена"""
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Сбой на стороне OpenAI (таймаут, сеть, 429, 5xx), а не ошибка в нашем запросе"""
+    from openai import APIConnectionError, APIStatusError, RateLimitError
+    if isinstance(error, (asyncio.TimeoutError, APIConnectionError, RateLimitError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def is_overload(error: BaseException) -> bool:
+    """OpenAI перегружен (таймаут, 429, 5xx): только это повод снижать лимит.
+    Обрыв соединения — сбой, но не признак того, что запросов слишком много"""
+    from openai import APIStatusError, APITimeoutError, RateLimitError
+    if isinstance(error, (asyncio.TimeoutError, APITimeoutError, RateLimitError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class AdaptiveLimiter:
+    """AIMD-лимит одновременных запросов: +1/limit за успех, ×0.7 при перегрузке апстрима"""
+
+    def __init__(self, minimum: int, maximum: int, max_queue: int, initial: Optional[int] = None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_queue = max_queue
+        # Стартуем с потолка: пока OpenAI не пожаловался, ограничивать нечего
+        self.limit = float(initial or maximum)
+        self.inflight = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def has_capacity(self) -> bool:
+        return self.inflight < int(self.limit) and not self._waiters
+
+    async def acquire(self, deadline: float):
+        """Занимает слот; ждёт не дольше дедлайна, при длинной очереди сразу отказывает"""
+        if self.has_capacity():
+            self.inflight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise OpenAIUnavailable("too many requests waiting for OpenAI")
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, deadline - loop.time())
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release(None)  # слот выдали одновременно с отменой — возвращаем
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            raise
+
+    def release(self, overloaded: Optional[bool]):
+        """Освобождает слот; overloaded=None — результат не говорит о состоянии апстрима"""
+        if overloaded:
+            now = time.monotonic()
+            # Одна волна таймаутов — одно снижение, а не по разу на каждый запрос
+            if now - self._last_decrease > 1.0:
+                self.limit = max(self.minimum, self.limit * 0.7)
+                self._last_decrease = now
+        elif overloaded is False:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self.inflight -= 1
+        while self._waiters and self.inflight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.inflight += 1
+                fut.set_result(None)
+
+
+class CircuitBreaker:
+    """Размыкается после N сбоев подряд; раз в cooldown пропускает один пробный запрос"""
+
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half-open":
+            # Пробный запрос: следующий — не раньше чем через cooldown, даже если этот повиснет
+            self._opened_at = time.monotonic()
+            return True
+        return state == "closed"
+
+    def record(self, ok: bool) -> bool:
+        """Учитывает исход запроса; возвращает True, если цепь только что разомкнулась"""
+        if ok:
+            self._count = 0
+            self._opened_at = None
+            return False
+        self._count += 1
+        if self._opened_at is None and self._count < self.failures:
+            return False
+        opened = self._opened_at is None
+        self._opened_at = time.monotonic()
+        return opened
+
+
+class OpenAIGuard:
+    """Дедлайны, адаптивный лимит, дублирование медленных запросов, предохранитель и запасная модель"""
+
+    def __init__(self):
+        self.limiter = AdaptiveLimiter(OPENAI_MIN_CONCURRENCY, OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE)
+        self._breakers = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_COOLDOWN)
+        return self._breakers[model]
+
+    def models(self, model: str) -> List[str]:
+        if OPENAI_FALLBACK_MODEL and OPENAI_FALLBACK_MODEL != model:
+            return [model, OPENAI_FALLBACK_MODEL]
+        return [model]
+
+    def _record(self, model: str, ok: bool):
+        if self.breaker(model).record(ok):
+            OPENAI_EVENTS.inc(model=model, event="breaker_open")
+            log.warning("OpenAI circuit for %s is open for %.0fs", model, OPENAI_BREAKER_COOLDOWN)
+
+    async def _acquire(self, model: str, deadline: float):
+        try:
+            await self.limiter.acquire(deadline)
+        except OpenAIUnavailable:
+            OPENAI_EVENTS.inc(model=model, event="shed")
+            raise
+
+    async def _attempt(self, kind: str, request: dict, deadline: float):
+        model = request["model"]
+        loop = asyncio.get_running_loop()
+        await self._acquire(model, deadline)
+        overloaded = None  # отмена (проиграл дублю) ничего не говорит об апстриме
+        try:
+            with OPENAI_LATENCY.time(model=model, kind=kind):
+                resp = await asyncio.wait_for(openai_client().chat.completions.create(**request), deadline - loop.time())
+            overloaded = False
+        except asyncio.CancelledError:
+            # _hedged снимает попытки по тому же дедлайну: если он вышел, это зависший
+            # OpenAI, а не проигрыш дублю — иначе предохранитель и лимит его не заметят
+            if loop.time() >= deadline:
+                count_error(f"openai_{kind}", asyncio.TimeoutError())
+                overloaded = True
+                self._record(model, False)
+            raise
+        except Exception as e:
+            count_error(f"openai_{kind}", e)
+            if is_upstream_failure(e):
+                overloaded = is_overload(e) or None
+                self._record(model, False)
+            raise
+        finally:
+            self.limiter.release(overloaded)
+        self._record(model, True)
+        record_usage(model, resp.usage)
+        return resp
+
+    async def _hedged(self, kind: str, request: dict, deadline: float):
+        """Первая попытка; если она медленная — дубль, если упала — повтор. Побеждает первый успех"""
+        loop = asyncio.get_running_loop()
+        model = request["model"]
+        pending, errors, launched = set(), [], 0
+
+        def launch():
+            nonlocal launched
+            launched += 1
+            pending.add(asyncio.ensure_future(self._attempt(kind, request, deadline)))
+
+        launch()
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                can_hedge = OPENAI_HEDGE_AFTER > 0 and launched < OPENAI_ATTEMPTS
+                timeout = min(remaining, OPENAI_HEDGE_AFTER) if can_hedge else remaining
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Дубль — только в свободный слот: в очередь за ним вставать незачем
+                    if can_hedge and self.limiter.has_capacity() and self.breaker(model).allow():
+                        OPENAI_EVENTS.inc(model=model, event="hedge")
+                        launch()
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    if not is_upstream_failure(error):
+                        raise error
+                    errors.append(error)
+                if not pending and launched < OPENAI_ATTEMPTS and self.breaker(model).allow():
+                    OPENAI_EVENTS.inc(model=model, event="retry")
+                    launch()
+            raise errors[-1]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(self, kind: str, request: dict):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + OPENAI_TIMEOUT
+        error = None
+        for model in self.models(request.get("model", "")):
+            if error is not None:
+                OPENAI_EVENTS.inc(model=model, event="fallback")
+            if not self.breaker(model).allow():
+                OPENAI_EVENTS.inc(model=model, event="rejected")
+                error = error or OpenAIUnavailable(f"circuit for {model} is open")
+                continue
+            try:
+                return await self._hedged(kind, {**request, "model": model}, deadline)
+            except Exception as e:
+                if not is_upstream_failure(e) or loop.time() >= deadline:
+                    raise
+                error = e
+        raise error
+
+    async def stream(self, kind: str, request: dict):
+        """Стриминг без дублей: запасная модель — только пока не отдан первый кусок текста"""
+        loop = asyncio.get_running_loop()
+        error = None
+        for model in self.models(request.get("model", "")):
+            if error is not None:
+                OPENAI_EVENTS.inc(model=model, event="fallback")
+            if not self.breaker(model).allow():
+                OPENAI_EVENTS.inc(model=model, event="rejected")
+                error = error or OpenAIUnavailable(f"circuit for {model} is open")
+                continue
+            started = False
+            await self._acquire(model, loop.time() + OPENAI_TIMEOUT)
+            overloaded = None
+            stream = None
+            start = time.perf_counter()
+            try:
+                stream = await asyncio.wait_for(openai_client().chat.completions.create(
+                    stream=True, stream_options={"include_usage": True}, **{**request, "model": model}
+                ), OPENAI_TIMEOUT)
+                chunks = stream.__aiter__()
+                while True:
+                    # OPENAI_TIMEOUT — на каждый кусок: длинный ответ можно, зависший нельзя
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), OPENAI_TIMEOUT)
+                    except StopAsyncIteration:
+                        break
+                    # Последний чанк приходит без choices, зато с usage
+                    record_usage(model, getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        started = True
+                        yield delta
+                overloaded = False
+                self._record(model, True)
+                return
+            except Exception as e:
+                count_error(f"openai_{kind}", e)
+                if not is_upstream_failure(e):
+                    raise
+                overloaded = is_overload(e) or None
+                self._record(model, False)
+                if started:
+                    raise
+                error = e
+            finally:
+                try:
+                    # Таймаут куска, ошибка или ушедший потребитель (GeneratorExit) —
+                    # без явного close() HTTP-соединение так и остаётся занятым
+                    if stream is not None:
+                        await stream.close()
+                finally:
+                    self.limiter.release(overloaded)
+                    OPENAI_LATENCY.observe(time.perf_counter() - start, model=model, kind=kind)
+        raise error
+
+
+OPENAI_GUARD = OpenAIGuard()
+METRICS.gauge("bot_openai_concurrency_limit", "Adaptive limit of concurrent OpenAI requests", lambda: OPENAI_GUARD.limiter.limit)
+METRICS.gauge("bot_openai_inflight", "OpenAI requests in flight", lambda: OPENAI_GUARD.limiter.inflight)
+METRICS.gauge("bot_openai_waiting", "OpenAI requests waiting for a slot", lambda: OPENAI_GUARD.limiter.waiting)
+
+
+async def complete(kind: str, **request):
+    """chat.completions.create через OPENAI_GUARD, с замером латентности и учётом токенов"""
+    return await OPENAI_GUARD.complete(kind, request)
+
+
+async def complete_stream(kind: str, **request):
+    """Потоковый вариант complete(): отдаёт кусочки текста по мере генерации"""
+    async for delta in OPENAI_GUARD.stream(kind, request):
+        yield delta
+
+# ─── КЭШ ────────────────────────────────────────────────────────────
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))    # записей в кэше поиска и саммари
+SEARCH_CACHE_TTL  = float(os.getenv("SEARCH_CACHE_TTL", "600"))   # время жизни записи, сек
+
+_MISSING = object()
+_RETRY = object()  # ответ ждущим, если ведущую загрузку отменили
+
+
+class TTLCache:
+    """LRU-кэш с TTL и объединением одновременных одинаковых запросов (single-flight)"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}         # key -> Future с результатом загрузки
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable]):
+        """Отдаёт значение из кэша или один раз вызывает loader для всех ждущих"""
+        while True:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                CACHE_EVENTS.inc(cache=self.name, event="hit")
+                return value
+
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+            self.coalesced += 1
+            CACHE_EVENTS.inc(cache=self.name, event="coalesced")
+            value = await asyncio.shield(fut)
+            if value is not _RETRY:
+                return value
+            # Ведущего отменили: его отмена не наша, загрузку начнёт кто-то из ждущих
+
+        self.misses += 1
+        CACHE_EVENTS.inc(cache=self.name, event="miss")
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            fut.set_result(_RETRY)
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как полученное, даже если никто не ждал
+            raise
+        else:
+            # None — это «ничего не нашли», такое не кэшируем
+            if value is not None:
+                self.put(key, value)
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+def normalize_query(query: str) -> str:
+    """Приводит запрос к ключу кэша: регистр, ё/е, пунктуация, пробелы"""
+    query = query.lower().replace("ё", "е")
+    query = re.sub(r"[^\w\s]", " ", query)
+    return " ".join(query.split())
+
+
+SEARCH_CACHE  = TTLCache("search", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+SUMMARY_CACHE = TTLCache("summary", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+QUERY_INDEX_SIZE      = int(os.getenv("QUERY_INDEX_SIZE", "512"))              # запросов в индексе похожих
+QUERY_INDEX_THRESHOLD = float(os.getenv("QUERY_INDEX_THRESHOLD", "0.8"))       # порог сходства (Жаккар), 0 — индекс выключен
+QUERY_INDEX_TTL       = float(os.getenv("QUERY_INDEX_TTL", str(SEARCH_CACHE_TTL)))  # сколько результаты считаются свежими, сек
+
+# Слова, от которых смысл запроса не меняется; остатки триггеров («и», «за») сюда же.
+# «Сегодня» и «сейчас» тоже: запрос без даты и так про сегодня
+QUERY_FILLERS = {
+    "и", "а", "за", "в", "во", "на", "по", "про", "о", "об", "мне", "нам", "ну", "вот", "же",
+    "пожалуйста", "плиз", "плз", "please", "pls", "сегодня", "сейчас", "today", "now",
+}
+# Слова, которые переворачивают смысл при почти тех же буквах: их расхождение — всегда другой запрос
+QUERY_NEGATIONS = {"не", "нет", "ни", "без", "нельзя", "not", "no", "without"}
+QUERY_DATE_WORDS = re.compile(
+    r"(?:поза|после)?(?:вчера|завтра)\w*|утр\w{0,2}|вечер\w{0,3}|ноч\w{0,2}|"
+    r"понедельник\w*|вторник\w*|сред[аеуы]|четверг\w*|пятниц\w*|суббот\w*|воскресень\w*|"
+    r"январ\w*|феврал\w*|март\w?|апрел\w*|ма[йяе]|июн\w*|июл\w*|август\w?|сентябр\w*|"
+    r"октябр\w*|ноябр\w*|декабр\w*|yesterday|tomorrow|tonight"
+)
+
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+class QueryIndex:
+    """MinHash по символьным 3-граммам основ слов: находит перефразировки недавних запросов.
+
+    Решает сходство: «погода в москве» ≈ «погода москва», «курс биткоина» ≈
+    «курс биткоина пожалуйста». Вето — в _compatible: запросы, расходящиеся
+    в отрицании, дате, числах, порядке слов или заменой слова, не склеиваются.
+
+    Подписи лежат в заранее выделенной матрице на size строк, так что память
+    ограничена; новая запись вытесняет просроченную или самую старую.
+    """
+
+    def __init__(self, size: int, ttl: float, threshold: float, permutations: int = 128, shingle: int = 3):
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.shingle = shingle
+        rng = np.random.default_rng(1)  # фиксированное зерно: подписи одинаковы во всех процессах
+        self._a = rng.integers(1, _MINHASH_PRIME, permutations, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, _MINHASH_PRIME, permutations, dtype=np.uint64)[:, None]
+        self._sigs = np.zeros((size, permutations), dtype=np.uint64)
+        self._expires = np.zeros(size)       # 0 — строка свободна
+        self._entries = [None] * size        # (ключ, num, результаты)
+        self._rows = {}                      # ключ -> строка
+        self._next = 0
+
+    @staticmethod
+    def canonical(query: str) -> str:
+        """Нормализованный запрос без слов-паразитов; порядок слов сохраняется"""
+        return " ".join(word for word in normalize_query(query).split() if word not in QUERY_FILLERS)
+
+    def signature(self, text: str):
+        padded = f" {text} "
+        shingles = {padded[i:i + self.shingle] for i in range(max(1, len(padded) - self.shingle + 1))}
+        hashes = np.fromiter((zlib.crc32(sh.encode()) % _MINHASH_PRIME for sh in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # a*h + b < 2^62: в uint64 без переполнения
+        return ((self._a * hashes + self._b) % _MINHASH_PRIME).min(axis=1)
+
+    @staticmethod
+    def _terms(text: str) -> tuple:
+        """Основы слов (первые 5 букв) по порядку: «москва» и «москве» совпадают"""
+        return tuple(word[:5] for word in text.split())
+
+    @classmethod
+    def _compatible(cls, a: str, b: str) -> bool:
+        """Вето поверх сходства: «сегодня»/«завтра», «как (не) убить», «лучший»/«худший»,
+        «москва тверь»/«тверь москва», «python 3.11»/«3.12» похожи по буквам, но это разные запросы"""
+        def marks(text, keep):
+            return cls._terms(" ".join(word for word in text.split() if keep(word)))
+
+        for keep in (QUERY_NEGATIONS.__contains__, str.isdigit, QUERY_DATE_WORDS.fullmatch):
+            if marks(a, keep) != marks(b, keep):
+                return False
+        # Один запрос может уточнять другой лишним словом, но не заменять слово на другое
+        a_terms, b_terms = cls._terms(a), cls._terms(b)
+        common = set(a_terms) & set(b_terms)
+        if common != set(a_terms) and common != set(b_terms):
+            return False
+        return [t for t in a_terms if t in common] == [t for t in b_terms if t in common]
+
+    def similarity(self, a: str, b: str) -> float:
+        """Оценка сходства двух запросов, как её видит lookup (без вето)"""
+        sig_a, sig_b = (self.signature(" ".join(self._terms(self.canonical(q)))) for q in (a, b))
+        return float((sig_a == sig_b).mean())
+
+    def lookup(self, query: str, num: int):
+        """Результаты похожего свежего запроса или None"""
+        text = self.canonical(query)
+        if not text:
+            return None
+        live = np.flatnonzero(self._expires > time.monotonic())
+        if not len(live):
+            return None
+        similarity = (self._sigs[live] == self.signature(" ".join(self._terms(text)))).mean(axis=1)
+        for i in np.argsort(similarity)[::-1]:
+            if similarity[i] < self.threshold:
+                break
+            key, entry_num, results = self._entries[live[i]]
+            if entry_num == num and self._compatible(text, key):
+                search_log.info("Похожий запрос: %r ≈ %r (%.2f)", query, key, similarity[i])
+                return results
+        return None
+
+    def add(self, query: str, num: int, results: List[dict]):
+        text = self.canonical(query)
+        if not text:
+            return
+        row = self._rows.get((text, num))
+        if row is not None and self._expires[row] > time.monotonic():
+            return  # свежесть считаем от первого похода в DDG, повторы её не продлевают
+        if row is None:
+            row = self._free_row()
+            old = self._entries[row]
+            if old is not None:
+                self._rows.pop((old[0], old[1]), None)
+        # Просроченную запись того же запроса обновляем на месте
+        self._sigs[row] = self.signature(" ".join(self._terms(text)))
+        self._expires[row] = time.monotonic() + self.ttl
+        self._entries[row] = (text, num, results)
+        self._rows[(text, num)] = row
+
+    def _free_row(self) -> int:
+        expired = np.flatnonzero(self._expires <= time.monotonic())
+        if len(expired):
+            return int(expired[0])
+        # Всё занято свежими: вытесняем по кругу, то есть самую старую запись
+        row, self._next = self._next, (self._next + 1) % self.size
+        return row
+
+
+_query_index = None
+
+
+def query_index() -> Optional[QueryIndex]:
+    """Индекс похожих запросов; создаётся при первом поиске вместе с импортом NumPy"""
+    global _query_index, np
+    if _query_index is None and NUMPY_AVAILABLE and QUERY_INDEX_THRESHOLD > 0 and QUERY_INDEX_SIZE > 0:
+        import numpy as np
+        _query_index = QueryIndex(QUERY_INDEX_SIZE, QUERY_INDEX_TTL, QUERY_INDEX_THRESHOLD)
+    return _query_index
+
+# ─── ПОИСК ──────────────────────────────────────────────────────────
+SEARCH_WORKERS      = int(os.getenv("SEARCH_WORKERS", "4"))        # потоков под DDGS
+SEARCH_TIMEOUT      = float(os.getenv("SEARCH_TIMEOUT", "10"))     # таймаут одного вызова, сек
+SEARCH_MIN_INTERVAL = float(os.getenv("SEARCH_MIN_INTERVAL", "0.5"))  # пауза между запросами к DDG, сек
+SEARCH_MODE         = os.getenv("SEARCH_MODE", "fallback").lower()  # fallback | race | merge
+SEARCH_BACKENDS     = [b.strip() for b in os.getenv("SEARCH_BACKENDS", "text,news").split(",") if b.strip()]
+SEARCH_DEADLINE     = float(os.getenv("SEARCH_DEADLINE", "5"))     # сколько ждать бэкенды в режиме merge, сек
+SEARCH_PER_DOMAIN   = int(os.getenv("SEARCH_PER_DOMAIN", "1"))     # сколько результатов с одного сайта показывать
+SEARCH_PROMPT_TOKENS = int(os.getenv("SEARCH_PROMPT_TOKENS", "350"))  # бюджет результатов в запросе на саммари
+SEARCH_OVERFETCH    = 3    # сколько результатов запрашивать сверх показываемых: часть уйдёт в дубли
+SEARCH_DUP_SIMILARITY = 0.7  # сниппеты с таким сходством слов считаются перепечаткой одного текста
+
+
+class SearchEngine:
+    """Асинхронная обёртка над DDGS: блокирующие вызовы уходят в ограниченный пул потоков"""
+
+    def __init__(self, workers: int, timeout: float, min_interval: float,
+                 mode: str = "fallback", backends: Optional[List[str]] = None,
+                 deadline: float = 5.0):
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.mode = mode
+        self.backends = backends or ["text", "news"]
+        self.deadline = min(deadline, timeout)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ddgs")
+        self._clients = queue.SimpleQueue()  # пул переиспользуемых DDGS-клиентов
+        self._pace_lock = None  # создаём внутри event loop
+        self._next_slot = 0.0
+        self._version_logged = False
+
+    def _acquire_client(self):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            if not self._version_logged:
+                self._version_logged = True
+                try:
+                    import ddgs
+                    search_log.info("DDGS version: %s", ddgs.__version__)
+                except Exception:
+                    search_log.warning("Could not get DDGS version")
+            return DDGS()
+
+    def _release_client(self, client):
+        self._clients.put(client)
+
+    def _call(self, method: str, query: str, num: int) -> List[dict]:
+        """Выполняется в потоке пула: берёт клиента из пула и возвращает его обратно"""
+        client = self._acquire_client()
+        try:
+            results = list(getattr(client, method)(query, max_results=num))
+        except Exception:
+            # Клиент после ошибки мог остаться в битом состоянии — не возвращаем его в пул
+            try:
+                client.close()
+            except Exception:
+                pass
+            raise
+        self._release_client(client)
+        return results
+
+    async def _pace(self):
+        """Выдерживает SEARCH_MIN_INTERVAL между запросами, не блокируя event loop"""
+        if self._pace_lock is None:
+            self._pace_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        async with self._pace_lock:
+            now = loop.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def run(self, method: str, query: str, num: int) -> List[dict]:
+        """Запускает один метод DDGS в пуле с таймаутом"""
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._executor, self._call, method, query, num)
+        return await asyncio.wait_for(fut, timeout=self.timeout)
+
+    async def search(self, query: str, num: int = 5) -> Optional[List[dict]]:
+        """Поиск по настроенным бэкендам в режиме SEARCH_MODE"""
+        await self._pace()
+        if self.mode == "race" and len(self.backends) > 1:
+            return await self._search_race(query, num)
+        if self.mode == "merge" and len(self.backends) > 1:
+            return await self._search_merge(query, num)
+        return await self._search_fallback(query, num)
+
+    async def _run_backend(self, method: str, query: str, num: int) -> Optional[List[dict]]:
+        """Один бэкенд: пустой результат и ошибка одинаково дают None"""
+        try:
+            search_log.info("Trying %s search for: %r", method, query)
+            results = await self.run(method, query, num)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            search_log.warning("%s search failed for %r: %r", method.capitalize(), query, e)
+            return None
+        if not results:
+            search_log.info("%s search returned nothing for query: %s", method.capitalize(), query)
+            return None
+        search_log.info("%s search successful for query: %s", method.capitalize(), query)
+        return results
+
+    async def _search_fallback(self, query: str, num: int) -> Optional[List[dict]]:
+        """Бэкенды по очереди, пока один не ответит (text -> news)"""
+        for method in self.backends:
+            results = await self._run_backend(method, query, num)
+            if results:
+                return results
+        return None
+
+    async def _search_race(self, query: str, num: int) -> Optional[List[dict]]:
+        """Все бэкенды параллельно, берём первый непустой ответ, остальные отменяем"""
+        tasks = [asyncio.ensure_future(self._run_backend(m, query, num)) for m in self.backends]
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results = task.result()
+                    if results:
+                        return results
+            return None
+        finally:
+            # Поток DDGS отменить нельзя, но его результат просто будет выброшен
+            for task in tasks:
+                task.cancel()
+
+    async def _search_merge(self, query: str, num: int) -> Optional[List[dict]]:
+        """Все бэкенды параллельно до SEARCH_DEADLINE, результаты склеиваются без дублей ссылок"""
+        tasks = [asyncio.ensure_future(self._run_backend(m, query, num)) for m in self.backends]
+        try:
+            await asyncio.wait(tasks, timeout=self.deadline)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        merged, seen = [], set()
+        # Порядок бэкендов сохраняется: text выше news
+        for task in tasks:
+            if task.cancelled() or not task.done() or not task.result():
+                continue
+            for r in task.result():
+                key = link_key(result_link(r)) or r.get("title", "")
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(r)
+        return merged or None
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        while True:
+            try:
+                client = self._clients.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                client.close()
+            except Exception:
+                pass
+
+
+SEARCH = SearchEngine(SEARCH_WORKERS, SEARCH_TIMEOUT, SEARCH_MIN_INTERVAL,
+                      SEARCH_MODE, SEARCH_BACKENDS, SEARCH_DEADLINE)
+
+
+def result_link(r: dict) -> str:
+    """Ссылка из результата DDGS: text отдаёт href, news — url"""
+    return r.get("href") or r.get("url") or r.get("link") or ""
+
+
+def link_key(link: str) -> str:
+    """Ключ для дедупликации ссылок: без схемы, www и хвостового слэша"""
+    link = link.strip().lower()
+    link = re.sub(r"^https?://(www\.)?", "", link)
+    return link.rstrip("/")
+
+
+def result_domain(r: dict) -> str:
+    return link_key(result_link(r)).partition("/")[0]
+
+
+def word_stems(text: str) -> set:
+    """Грубые основы слов (первые 5 букв): «биткоина» и «биткоин» совпадают"""
+    return {word[:5] for word in re.findall(r"\w{3,}", text.lower())}
+
+
+def prepare_results(query: str, results: List[dict], num: int = 5) -> List[dict]:
+    """Ранжирует результаты по совпадению со словами запроса и убирает дубли.
+
+    Дубль — ещё один результат с того же сайта сверх SEARCH_PER_DOMAIN или сниппет,
+    почти совпадающий с уже взятым (перепечатки новостей). При равных очках
+    сохраняется порядок поисковика.
+    """
+    terms = word_stems(query)
+    scored = []
+    for position, r in enumerate(results):
+        title, body = word_stems(r.get("title", "")), word_stems(r.get("body", ""))
+        scored.append((-(2 * len(terms & title) + len(terms & body)), position, body, r))
+    scored.sort(key=lambda item: item[:2])
+
+    kept, kept_bodies, per_domain = [], [], {}
+    for _, _, body, r in scored:
+        domain = result_domain(r)
+        if domain and per_domain.get(domain, 0) >= SEARCH_PER_DOMAIN:
+            continue
+        if body and any(len(body & other) / len(body | other) >= SEARCH_DUP_SIMILARITY for other in kept_bodies):
+            continue
+        per_domain[domain] = per_domain.get(domain, 0) + 1
+        kept_bodies.append(body)
+        kept.append(r)
+        if len(kept) == num:
+            break
+    return kept
+
+
+def search_prompt(results: List[dict], budget: int = SEARCH_PROMPT_TOKENS) -> str:
+    """Результаты для запроса на саммари: без ссылок и разметки, в пределах budget токенов"""
+    lines, used = [], 0
+    for i, r in enumerate(results, 1):
+        snippet = " ".join(r.get("body", "").split())
+        if len(snippet) > 200:  # как в format_results
+            snippet = snippet[:200] + "…"
+        line = f"{i}. {r.get('title', '').strip()}: {snippet}"
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            # Последний результат обрезаем по словам, если под него осталось хоть сколько-то места
+            room = (budget - used - 4) * 4  # байт UTF-8, по оценке estimate_tokens
+            if room >= 160:
+                lines.append(line.encode("utf-8")[:room].decode("utf-8", "ignore").rsplit(" ", 1)[0] + "…")
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
+
+
+def format_results(results: List[dict], num: int = 5) -> str:
+    """Форматирует результаты DDGS в markdown-список"""
+    lines = []
+    for i, r in enumerate(results[:num], 1):
+        title = r.get("title", "Без заголовка")
+        link = result_link(r)
+        snippet = r.get("body", "")
+
+        # Ограничиваем длину сниппета
+        if len(snippet) > 200:
+            snippet = snippet[:200] + "..."
+
+        lines.append(f"{i}. **{title}**\n   {snippet}\n   {link}\n")
+
+    return "\n".join(lines)
+
+
+async def search_results(query: str, num: int = 5) -> Optional[List[dict]]:
+    """Результаты поиска через кэш: повторные, одновременные и перефразированные запросы не ходят в DDG"""
+    key = (normalize_query(query) or query, num)
+    index = query_index()
+    if index is not None and SEARCH_CACHE.get(key) is None:
+        results = index.lookup(query, num)
+        if results is not None:
+            CACHE_EVENTS.inc(cache="search", event="near_hit")
+            return results
+    results = await SEARCH_CACHE.get_or_load(key, lambda: SEARCH.search(query, num))
+    if index is not None and results:
+        index.add(query, num, results)
+    return results
+
+
+async def web_search(query: str, num: int = 5) -> Optional[List[dict]]:
+    """Поиск через DuckDuckGo, не блокирующий event loop: num лучших результатов без дублей"""
+    if DDGS_AVAILABLE is not True:
+        search_log.error("ddgs не установлен")
+        return None
+
+    try:
+        search_log.info("Starting search for query: %r", query)
+        with STAGE_LATENCY.time(stage="search"):
+            results = await search_results(query, num + SEARCH_OVERFETCH)
+
+        if not results:
+            search_log.warning("No search results for query: %s", query)
+            return None
+
+        found = len(results)
+        results = prepare_results(query, results, num)
+        search_log.info("Found %d results (%d after dedup) for query: %s", found, len(results), query)
+        return results
+
+    except Exception as e:
+        count_error("search", e)
+        search_log.error("Search error for query %r: %s", query, e)
+        return None
+
+
+def summary_request(query: str, prompt_md: str) -> dict:
+    """Параметры запроса к OpenAI для саммари результатов поиска"""
+    return dict(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system",
+             "content": "Ты помощник для анализа результатов поиска. Кратко резюмируй найденную информацию на русском языке в 2-3 предложения."},
+            {"role": "user",
+             "content": f"Проанализируй результаты поиска по запросу '{query}':\n\n{prompt_md}"}
+        ],
+        temperature=0.3,
+        max_tokens=300
+    )
+
+
+def summary_key(prompt_md: str):
+    # Только по результатам: у перефразированного запроса из query_index() они те же, и саммари тоже.
+    # sha256, а не hash(): при коллизии 64-битного хэша пользователь получил бы чужое саммари
+    return hashlib.sha256(prompt_md.encode()).hexdigest()
+
+
+async def summarize_results(query: str, prompt_md: str) -> str:
+    """Краткое саммари результатов поиска (см. search_prompt) через OpenAI, с кэшем"""
+    async def load():
+        summary_resp = await complete("summary", **summary_request(query, prompt_md))
+        return summary_resp.choices[0].message.content
+
+    return await SUMMARY_CACHE.get_or_load(summary_key(prompt_md), load)
+
+# ─── СТРИМИНГ ОТВЕТОВ ───────────────────────────────────────────────
+STREAM_REPLIES       = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes", "on")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # как часто редактировать сообщение, сек
+STREAM_PLACEHOLDER   = "✍️…"
+
+
+class StreamingReply:
+    """Ответ, который дописывается по мере генерации: плейсхолдер + редкие edit'ы"""
+
+    def __init__(self, msg, interval: float = STREAM_EDIT_INTERVAL, chunk: int = MAX_CHUNK):
+        self.msg = msg
+        self.interval = interval
+        self.chunk = chunk
+        self._current = None  # сообщение, которое сейчас дописываем
+        self._text = ""       # текст текущего сообщения
+        self._shown = ""      # что уже видно пользователю в текущем сообщении
+        self._last_edit = 0.0
+
+    async def start(self):
+        """Сразу отправляет плейсхолдер, чтобы пользователь видел, что бот пишет"""
+        self._current = await OUTBOX.send(self.msg.chat_id, STREAM_PLACEHOLDER, self.msg.message_id, coalesce=False)
+        self._last_edit = time.monotonic()
+
+    @property
+    def message(self):
+        """Последнее отправленное сообщение ответа"""
+        return self._current
+
+    @property
+    def text(self) -> str:
+        """Текст текущего (ещё не закрытого) сообщения"""
+        return self._text
+
+    async def append(self, delta: str):
+        if not delta:
+            return
+        self._text += delta
+        while len(self._text) > self.chunk:
+            await self._rollover()
+        if time.monotonic() - self._last_edit >= self.interval:
+            await self._edit(self._text)
+
+    async def reset(self, text: str = ""):
+        """Заменяет недописанный текст текущего сообщения"""
+        self._text = ""
+        await self.append(text)
+
+    async def finish(self, tail: str = ""):
+        """Дописывает хвост и показывает финальный текст без задержки"""
+        self._text += tail
+        while len(self._text) > self.chunk:
+            await self._rollover()
+        await self._edit(self._text if self._text.strip() else "🤷", wait=True)
+
+    async def _rollover(self):
+        """Дописывает текущее сообщение до MAX_CHUNK и начинает следующее"""
+        head, self._text = self._text[:self.chunk], self._text[self.chunk:]
+        await self._edit(head, wait=True)
+        first = self._text[:self.chunk]
+        self._shown = first if first.strip() else STREAM_PLACEHOLDER
+        self._current = await OUTBOX.send(self.msg.chat_id, self._shown, self.msg.message_id, coalesce=False)
+        self._last_edit = time.monotonic()
+
+    async def _edit(self, text: str, wait: bool = False):
+        """Промежуточные правки не ждём: очередь исходящих склеит их в последнюю"""
+        self._last_edit = time.monotonic()
+        if not text.strip() or text == self._shown:
+            return  # Telegram ругается на «message is not modified»
+        self._shown = text
+        fut = OUTBOX.edit(self.msg.chat_id, self._current.message_id, text)
+        if not wait:
+            fut.add_done_callback(_consume_result)
+            return
+        try:
+            await fut
+        except BadRequest as e:
+            log.warning("Stream edit failed: %s", e)
+
+
+async def stream_completion(reply: StreamingReply, kind: str, **kwargs) -> str:
+    """Стримит ответ OpenAI в StreamingReply и возвращает полный текст"""
+    parts = []
+    async for delta in complete_stream(kind, **kwargs):
+        parts.append(delta)
+        await reply.append(delta)
+    return "".join(parts)
+
+# ─── АВТОМАТИЧЕСКАЯ ПРОВЕРКА ОБНОВЛЕНИЙ ──────────────────────────────
+from datetime import datetime
+
+UPDATE_CHECK_INTERVAL = timedelta(hours=1)  # Проверяем GitHub каждый час
+AUTO_UPDATE_POLL      = 60                  # Как часто смотреть на mtime файлов cron, сек
+GITHUB_COMMITS_URL    = "https://api.github.com/repos/schudarin/not-your-mama-bot/commits/master"
+CRON_SCRIPT           = "/opt/not-your-mama-bot/cron-update.sh"
+CRONTAB_FILE          = "/var/spool/cron/crontabs/botuser"  # меняется при crontab -e / -r
+
+
+class UpdateSnapshot(NamedTuple):
+    current: str                     # SHA текущего HEAD ("" если не удалось узнать)
+    latest: str                      # SHA последнего коммита на GitHub
+    available: bool                  # есть более новая версия
+    auto_update: bool                # включено автообновление через cron
+    checked_at: Optional[datetime]   # когда GitHub последний раз ответил
+    failed: bool = False             # последняя проверка не удалась
+
+    @property
+    def short(self) -> str:
+        return self.current[:7] if self.current else "Неизвестно"
+
+
+class UpdateChecker:
+    """Фоновая проверка обновлений; хэндлеры читают только готовый self.snapshot"""
+
+    def __init__(self):
+        self.snapshot = UpdateSnapshot("", "", False, False, None)
+        self._session = None
+        self._etag = None
+        self._watched = None
+        self._task = None
+        self._published = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def _publish(self):
+        """Отдаёт снимок через STATE_DB воркерам, которые сами GitHub и crontab не опрашивают"""
+        data = self.snapshot._asdict()
+        if data["checked_at"] is not None:
+            data["checked_at"] = data["checked_at"].isoformat()
+        if data != self._published:
+            self._published = data
+            STORE.set_meta("update_snapshot", data)
+
+    def follow(self, data: dict):
+        """Принимает снимок от проверяющего процесса (BOT_WORKERS > 1)"""
+        if self._task is not None:
+            return  # проверяем сами
+        data = {key: data[key] for key in UpdateSnapshot._fields if key in data}
+        if data.get("checked_at"):
+            data["checked_at"] = datetime.fromisoformat(data["checked_at"])
+        self.snapshot = self.snapshot._replace(**data)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _run(self):
+        # HEAD не меняется, пока процесс жив: обновление всегда означает рестарт
+        current = await self._git_head()
+        self.snapshot = self.snapshot._replace(current=current)
+        await self.refresh_auto_update(force=True)
+
+        await asyncio.sleep(10)  # Ждем 10 секунд перед первой проверкой
+        loop = asyncio.get_running_loop()
+        next_check = loop.time()
+        while True:
+            try:
+                if loop.time() >= next_check:
+                    next_check = loop.time() + UPDATE_CHECK_INTERVAL.total_seconds()
+                    await self.check()
+                    # Раз в интервал перепроверяем crontab, даже если его файл нам не виден
+                    await self.refresh_auto_update(force=True)
+                else:
+                    await self.refresh_auto_update()
+            except Exception as e:
+                update_log.error("Ошибка в периодической проверке обновлений: %s", e)
+            self._publish()
+            await asyncio.sleep(AUTO_UPDATE_POLL)
+
+    @staticmethod
+    async def _git_head() -> str:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "git", "rev-parse", "HEAD",
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, _ = await process.communicate()
+            return stdout.decode('utf-8').strip() if process.returncode == 0 else ""
+        except Exception as e:
+            update_log.warning("Не удалось определить версию: %s", e)
+            return ""
+
+    @staticmethod
+    def _mtimes():
+        result = []
+        for path in (CRON_SCRIPT, CRONTAB_FILE):
+            try:
+                result.append(os.stat(path).st_mtime)
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    async def refresh_auto_update(self, force: bool = False):
+        """Перечитывает crontab только если изменились файлы cron"""
+        watched = self._mtimes()
+        if watched == self._watched and not force:
+            return
+        self._watched = watched
+        enabled = await self._crontab_has_update()
+        if enabled != self.snapshot.auto_update:
+            update_log.info("Автообновление %s", "включено" if enabled else "выключено")
+        self.snapshot = self.snapshot._replace(auto_update=enabled)
+
+    @staticmethod
+    async def _crontab_has_update() -> bool:
+        """Проверяет, включено ли автообновление через cron"""
+        if not os.path.exists(CRON_SCRIPT):
+            return False
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "crontab", "-u", "botuser", "-l",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, _ = await process.communicate()
+            return process.returncode == 0 and "cron-update.sh" in stdout.decode('utf-8')
+        except Exception as e:
+            update_log.warning("Ошибка проверки автообновления: %s", e)
+            return False
+
+    async def check(self):
+        """Спрашивает GitHub о последнем коммите; 304 Not Modified ничего не стоит по лимитам"""
+        if self._session is None:
+            import aiohttp  # aiohttp нужен только здесь и в серверах — не тянем его на старте
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+        headers = {"Accept": "application/vnd.github+json"}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+
+        try:
+            async with self._session.get(GITHUB_COMMITS_URL, headers=headers) as response:
+                if response.status == 304:
+                    self.snapshot = self.snapshot._replace(checked_at=datetime.now(), failed=False)
+                    return
+                if response.status != 200:
+                    update_log.warning("GitHub ответил %s при проверке обновлений", response.status)
+                    self.snapshot = self.snapshot._replace(failed=True)
+                    return
+                self._etag = response.headers.get("ETag")
+                data = await response.json()
+        except Exception as e:
+            update_log.warning("Ошибка проверки обновлений: %s", e)
+            self.snapshot = self.snapshot._replace(failed=True)
+            return
+
+        latest_commit = data.get('sha', '')
+        current = self.snapshot.current
+        available = bool(latest_commit and current and latest_commit != current)
+        if available and not self.snapshot.available:
+            update_log.info("Доступно обновление: %s -> %s", current[:8], latest_commit[:8])
+        self.snapshot = self.snapshot._replace(
+            latest=latest_commit, available=available, checked_at=datetime.now(), failed=False
+        )
+
+
+UPDATES = UpdateChecker()
+
+
+def should_notify_about_updates() -> bool:
+    """Определяет, нужно ли уведомлять об обновлениях"""
+    # Уведомляем только если автообновление не включено
+    snapshot = UPDATES.snapshot
+    return snapshot.available and not snapshot.auto_update
+
+
+
+# ─── ПАМЯТЬ ДИАЛОГОВ ────────────────────────────────────────────────
+MEMORY_TURNS     = int(os.getenv("MEMORY_TURNS", "20"))         # реплик на чат
+MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "1000"))   # чатов в памяти
+MEMORY_MAX_CHARS = int(os.getenv("MEMORY_MAX_CHARS", "2000000"))  # текста во всех чатах суммарно
+MEMORY_IDLE_TTL  = float(os.getenv("MEMORY_IDLE_TTL", "21600"))  # забывать чат после простоя, сек
+CONTEXT_TOKENS   = int(os.getenv("CONTEXT_TOKENS", "1500"))     # бюджет истории в промпте, токенов
+
+
+class Turn(NamedTuple):
+    seq: int                  # порядковый номер: история собирается в хронологическом порядке
+    role: str                 # "user" | "assistant"
+    text: str
+    message_id: Optional[int]
+    reply_to: Optional[int]   # на какое сообщение это был ответ
+
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая локальная оценка: ~4 байта UTF-8 на токен плюс служебные токены сообщения"""
+    return (len(text.encode("utf-8")) + 3) // 4 + 4
+
+
+class _ChatHistory:
+    __slots__ = ("turns", "by_id", "last_used")
+
+    def __init__(self, size: int):
+        self.turns = deque(maxlen=size)  # кольцевой буфер последних реплик
+        self.by_id = {}                  # message_id -> Turn, для цепочек reply_to
+        self.last_used = time.monotonic()
+
+
+class ConversationMemory:
+    """Ограниченная память диалогов: кольцевой буфер на чат, общий лимит и вытеснение простаивающих"""
+
+    def __init__(self, turns: int, max_chats: int, max_chars: int, idle_ttl: float):
+        self.turns = turns
+        self.max_chats = max_chats
+        self.max_chars = max_chars
+        self.idle_ttl = idle_ttl
+        self._chats = OrderedDict()  # chat_id -> _ChatHistory, от давно активных к недавним
+        self._seq = 0
+        self.chars = 0
+
+    def add(self, chat_id: int, role: str, text: str,
+            message_id: Optional[int] = None, reply_to: Optional[int] = None):
+        history = self._chats.get(chat_id)
+        if history is None:
+            history = self._chats[chat_id] = _ChatHistory(self.turns)
+        self._chats.move_to_end(chat_id)
+        history.last_used = time.monotonic()
+
+        if len(history.turns) == history.turns.maxlen:
+            self._forget(history, history.turns[0])
+        self._seq += 1
+        turn = Turn(self._seq, role, text, message_id, reply_to)
+        history.turns.append(turn)
+        if message_id is not None:
+            history.by_id[message_id] = turn
+        self.chars += len(text)
+        self._evict()
+
+    def _forget(self, history: _ChatHistory, turn: Turn):
+        if turn.message_id is not None and history.by_id.get(turn.message_id) is turn:
+            del history.by_id[turn.message_id]
+        self.chars -= len(turn.text)
+
+    def _drop_chat(self, chat_id: int):
+        history = self._chats.pop(chat_id)
+        self.chars -= sum(len(t.text) for t in history.turns)
+
+    def _evict(self):
+        # Сначала простаивающие чаты (они в начале OrderedDict), потом самые старые сверх лимитов
+        deadline = time.monotonic() - self.idle_ttl
+        while self._chats:
+            chat_id, history = next(iter(self._chats.items()))
+            if history.last_used >= deadline and len(self._chats) <= self.max_chats and self.chars <= self.max_chars:
+                break
+            self._drop_chat(chat_id)
+
+    def history(self, chat_id: int) -> List[Turn]:
+        history = self._chats.get(chat_id)
+        return list(history.turns) if history else []
+
+    def get(self, chat_id: int, message_id: Optional[int]) -> Optional[Turn]:
+        history = self._chats.get(chat_id)
+        if history is None or message_id is None:
+            return None
+        return history.by_id.get(message_id)
+
+
+class ContextAssembler:
+    """Собирает историю под бюджет токенов: сначала цепочка reply_to, потом от новых реплик к старым"""
+
+    def __init__(self, memory: ConversationMemory, budget: int):
+        self.memory = memory
+        self.budget = budget
+
+    def build(self, chat_id: int, reply_to=None, budget: Optional[int] = None) -> List[dict]:
+        """reply_to — сообщение Telegram, на которое отвечает пользователь (или None)"""
+        budget = self.budget if budget is None else budget
+        selected = {}
+        used = 0
+
+        def take(turn: Turn) -> bool:
+            nonlocal used
+            cost = estimate_tokens(turn.text)
+            if used + cost > budget:
+                return False
+            selected[turn.seq] = turn
+            used += cost
+            return True
+
+        # 1) Цепочка ответов — самый релевантный контекст
+        message_id = reply_to.message_id if reply_to else None
+        seen = set()
+        while message_id is not None and message_id not in seen:
+            seen.add(message_id)
+            turn = self.memory.get(chat_id, message_id)
+            if turn is None:
+                if reply_to is not None and message_id == reply_to.message_id and reply_to.text:
+                    # Сообщения нет в памяти (например, после рестарта) — берём текст из самого апдейта
+                    role = "assistant" if reply_to.from_user and reply_to.from_user.username == BOT_USERNAME else "user"
+                    take(Turn(0, role, reply_to.text, message_id, None))
+                break
+            if turn.seq in selected or not take(turn):
+                break
+            message_id = turn.reply_to
+
+        # 2) Свежая история, пока хватает бюджета
+        for turn in reversed(self.memory.history(chat_id)):
+            if turn.seq in selected:
+                continue
+            if not take(turn):
+                break
+
+        return [{"role": t.role, "content": t.text} for _, t in sorted(selected.items())]
+
+
+MEMORY  = ConversationMemory(MEMORY_TURNS, MEMORY_MAX_CHATS, MEMORY_MAX_CHARS, MEMORY_IDLE_TTL)
+CONTEXT = ContextAssembler(MEMORY, CONTEXT_TOKENS)
+
+
+def remember_exchange(msg, prompt: str, answer_text: str, sent):
+    """Запоминает вопрос пользователя и ответ бота"""
+    text = prompt
+    if msg.chat.type != "private" and msg.from_user:
+        # В группах собеседников несколько — подписываем реплики
+        text = f"{msg.from_user.first_name}: {prompt}"
+    reply_to = msg.reply_to_message.message_id if msg.reply_to_message else None
+    MEMORY.add(msg.chat_id, "user", text, msg.message_id, reply_to)
+    MEMORY.add(msg.chat_id, "assistant", answer_text,
+               getattr(sent, "message_id", None), msg.message_id)
+
+# ─── ТРИГГЕРЫ ───────────────────────────────────────────────────────
+# ловим «интернет/сеть/поиск/гугл/гугли/гуглить/найди/найдёшь» — слово целиком, иначе
+# от «найди курс» в запросе оставалось «и курс»
+SEARCH_TRIGGERS = r"интернет\w*|сеть|поиск\w*|гугл(?:и|я|ить)?|погугл(?:и|я|ить)?|найд\w*"
+
+
+class Trigger(NamedTuple):
+    addressed: bool  # сообщение адресовано боту
+    search: bool     # есть поисковый интент
+    query: str       # текст без служебных и поисковых слов
+    prompt: str      # текст без обращения к боту
+
+
+IGNORED = Trigger(False, False, "", "")
+
+
+class TriggerMatcher:
+    """Разбирает сообщение за один проход заранее скомпилированным регэкспом"""
+
+    def __init__(self, bot_username: str):
+        parts = []
+        if bot_username:
+            parts.append(f"(?P<mention>@{re.escape(bot_username)})")
+        parts.append("(?P<rude>мразь)")
+        parts.append(f"(?P<search>{SEARCH_TRIGGERS})")
+        self._pattern = re.compile("|".join(parts), re.IGNORECASE)
+        self._mention = f"@{bot_username}".lower() if bot_username else None
+
+    def is_addressed(self, text: str, private: bool = False, reply_to_bot: bool = False) -> bool:
+        """Дешёвый префильтр: в группах без обращения к боту дальше не идём"""
+        if private or reply_to_bot:
+            return True
+        text_lower = text.lower()
+        return "мразь" in text_lower or (self._mention is not None and self._mention in text_lower)
+
+    def match(self, text: str, private: bool = False, reply_to_bot: bool = False) -> Trigger:
+        if not self.is_addressed(text, private, reply_to_bot):
+            return IGNORED
+
+        search = False
+        query_parts, prompt_parts = [], []
+        last = 0
+        for m in self._pattern.finditer(text):
+            chunk = text[last:m.start()]
+            query_parts.append(chunk)
+            prompt_parts.append(chunk)
+            if m.lastgroup == "search":
+                search = True
+                prompt_parts.append(m.group())  # поисковые слова в обычном ответе не мешают
+            last = m.end()
+        query_parts.append(text[last:])
+        prompt_parts.append(text[last:])
+
+        prompt = "".join(prompt_parts).strip()
+        # Если после удаления триггерных слов ничего не осталось, ищем по всему тексту
+        query = " ".join("".join(query_parts).split()) or prompt or text.strip()
+        return Trigger(True, search, query, prompt)
+
+
+TRIGGERS = TriggerMatcher(BOT_USERNAME)
+
+
+def match_trigger(msg) -> Trigger:
+    """Разбор текстового сообщения: обращаются ли к боту, поиск ли это"""
+    is_reply_to_bot = bool(
+        msg.reply_to_message and msg.reply_to_message.from_user
+        and msg.reply_to_message.from_user.username == BOT_USERNAME
+    )
+    return TRIGGERS.match(msg.text, msg.chat.type == "private", is_reply_to_bot)
+
+# ─── ДИСПЕТЧЕР АПДЕЙТОВ ─────────────────────────────────────────────
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))  # одновременно обрабатываемых апдейтов
+
+
+LANES = ("fast", "chat", "search")  # по убыванию приоритета
+LANE_QUEUE_SIZE = int(os.getenv("LANE_QUEUE_SIZE", "200"))  # сколько апдейтов может ждать в каждой полосе
+LANE_DEADLINES = {
+    # Сколько апдейт может ждать обработки, прежде чем бот ответит «занят», сек
+    "fast":   float(os.getenv("QUEUE_DEADLINE_FAST", "10")),
+    "chat":   float(os.getenv("QUEUE_DEADLINE_CHAT", "60")),
+    "search": float(os.getenv("QUEUE_DEADLINE_SEARCH", "60")),
+}
+BUSY_REPLY = "⏳ Сейчас слишком много запросов, не успеваю ответить. Повторите чуть позже."
+
+SHED = METRICS.counter("bot_shed_total", "Updates dropped by the scheduler", ("lane", "reason"))
+
+
+class LaneFull(Exception):
+    """В полосе нет места"""
+
+
+class LaneScheduler:
+    """Слоты обработки с приоритетными полосами: освободившийся слот получает самая важная полоса.
+
+    У каждого ждущего свой дедлайн: не дождался — получает TimeoutError и место в очереди освобождает.
+    """
+
+    def __init__(self, slots: int, size: int = LANE_QUEUE_SIZE):
+        self.slots = slots
+        self.size = size
+        self.free = slots
+        self._lanes = {lane: deque() for lane in LANES}
+        self.dropped = {lane: 0 for lane in LANES}
+
+    def depth(self) -> dict:
+        return {lane: len(waiters) for lane, waiters in self._lanes.items()}
+
+    async def acquire(self, lane: str, deadline: float):
+        loop = asyncio.get_running_loop()
+        if deadline <= loop.time():
+            raise asyncio.TimeoutError()  # устарел, пока ждал своей очереди в чате
+        # Пока есть свободные слоты, очереди пусты: release() сразу отдаёт слот ждущему
+        if self.free > 0:
+            self.free -= 1
+            return
+        waiters = self._lanes[lane]
+        if len(waiters) >= self.size:
+            raise LaneFull(lane)
+        fut = loop.create_future()
+        waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, deadline - loop.time())
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release()  # слот выдали одновременно с таймаутом — отдаём следующему
+            elif fut in waiters:
+                waiters.remove(fut)
+            raise
+
+    def release(self):
+        for lane in LANES:
+            waiters = self._lanes[lane]
+            while waiters:
+                fut = waiters.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    return
+        self.free += 1
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных чатов обрабатываются параллельно, апдейты одного чата — строго по очереди.
+
+    Свободные слоты раздаются по приоритету полос (LANES); команды не ждут очереди своего чата.
+    """
+
+    def __init__(self, max_concurrent: int):
+        # Семафор базового класса ограничивает только число ожидающих задач;
+        # реальный лимит параллельности — self.scheduler, слот в котором берётся уже после
+        # очереди чата, чтобы ждущий своей очереди апдейт не занимал слот
+        super().__init__(max_concurrent * 16)
+        self.limit = max_concurrent
+        self.scheduler = None
+        self._chats = {}  # chat_id -> [Lock, сколько апдейтов ждёт или выполняется]
+        self.active = 0
+        self._inflight = {}   # задача -> [апдейт, начал ли работу хэндлер]
+        self.completed = 0
+        self.draining = False  # время на остановку вышло: новые апдейты только откладываем
+        self.spilled = []      # апдейты, отложенные до следующего запуска
+
+    async def initialize(self):
+        self.scheduler = LaneScheduler(self.limit)
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def chat_key(update) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    @staticmethod
+    def lane_of(update) -> tuple:
+        """(полоса, обращаются ли к боту): второе решает, отвечать ли «занят» при отказе"""
+        msg = update.effective_message if isinstance(update, Update) else None
+        if msg is None or not msg.text:
+            return "fast", False
+        if msg.text.startswith("/"):
+            return "fast", True
+        trigger = match_trigger(msg)
+        if not trigger.addressed:
+            return "fast", False  # «не нам»: хэндлер выйдет сразу, держать в очереди незачем
+        return ("search" if trigger.search else "chat"), True
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            if not UPDATE_JOURNAL.admit(update):
+                coroutine.close()
+                return
+            if self.draining:
+                coroutine.close()
+                self._spill(update)
+                return
+        task = asyncio.current_task()
+        entry = self._inflight[task] = [update, False]
+        try:
+            await self._dispatch(update, coroutine)
+            self.completed += 1
+        except asyncio.CancelledError:
+            if not entry[1]:  # хэндлер не начинал работу — повторим апдейт при следующем запуске
+                coroutine.close()
+                if isinstance(update, Update):
+                    self._spill(update)
+            raise
+        finally:
+            self._inflight.pop(task, None)
+
+    def _spill(self, update: Update):
+        # Ответ на склеенную серию несёт только её последний апдейт: откладываем всю серию
+        self.spilled.extend(DEBOUNCER.with_burst(update))
+
+    async def drain(self, timeout: float, queued: Callable[[], int] = lambda: 0) -> tuple:
+        """Даёт начатым и ждущим апдейтам timeout секунд, остальные прерывает.
+
+        queued — сколько апдейтов ещё не дошло до диспетчера (update_queue приложения).
+
+        Прерванные до начала работы хэндлера уходят в self.spilled (их повторит следующий
+        запуск), начатые — теряются: повтор мог бы прислать ответ дважды.
+        Возвращает (сколько дождались, сколько прервали посреди работы).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        completed = self.completed
+        while (self._inflight or queued()) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        finished = self.completed - completed
+        self.draining = True
+        tasks = list(self._inflight)
+        aborted = sum(1 for _, started in self._inflight.values() if started)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return finished, aborted
+
+    async def _dispatch(self, update, coroutine):
+        lane, addressed = self.lane_of(update)
+        deadline = asyncio.get_running_loop().time() + LANE_DEADLINES[lane]
+        chat_id = self.chat_key(update)
+        # Быстрая полоса не ждёт очереди чата: /ping не стоит за чужим поиском
+        if chat_id is None or lane == "fast":
+            return await self._run(update, lane, addressed, deadline, coroutine)
+
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock будит ждущих в порядке FIFO — порядок апдейтов в чате сохраняется
+            async with entry[0]:
+                await self._run(update, lane, addressed, deadline, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[chat_id]
+
+    async def _run(self, update, lane: str, addressed: bool, deadline: float, coroutine):
+        try:
+            await self.scheduler.acquire(lane, deadline)
+        except (LaneFull, asyncio.TimeoutError) as e:
+            coroutine.close()
+            reason = "full" if isinstance(e, LaneFull) else "deadline"
+            self.scheduler.dropped[lane] += 1
+            SHED.inc(lane=lane, reason=reason)
+            if addressed:
+                await self._busy(update)
+            return
+        if self.draining:
+            # Слот выдали одновременно с отменой (asyncio.wait_for в 3.11 её проглатывает)
+            self.scheduler.release()
+            coroutine.close()
+            if isinstance(update, Update):
+                self._spill(update)
+            return
+        self._inflight[asyncio.current_task()][1] = True
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.scheduler.release()
+
+    @staticmethod
+    async def _busy(update):
+        # Не чаще раза в минуту на чат: под нагрузкой не заваливаем его отказами
+        if update.effective_message is None or not LEDGER.should_notice(update.effective_chat.id):
+            return
+        try:
+            await answer(update.effective_message, BUSY_REPLY)
+        except Exception as e:
+            log.warning("Не удалось ответить «занят»: %s", e)
+
+# ─── СКЛЕЙКА СЕРИЙ СООБЩЕНИЙ ────────────────────────────────────────
+DEBOUNCE_WINDOW       = float(os.getenv("DEBOUNCE_WINDOW", "1.5"))  # окно для «/debounce on», сек
+DEBOUNCE_MAX_WINDOW   = 10.0  # больше не разрешаем: ответа придётся ждать слишком долго
+DEBOUNCE_MAX_MESSAGES = 10    # столько сообщений в серии — отвечаем, не дожидаясь конца окна
+
+
+class _Burst:
+    __slots__ = ("updates", "prompts", "trigger", "application", "started", "timer")
+
+    def __init__(self, started: float):
+        self.updates = []
+        self.prompts = []
+        self.trigger = None
+        self.application = None
+        self.started = started
+        self.timer = None
 
-# Загружаем переменные окружения из .env файла
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except ImportError:
-    # Если python-dotenv не установлен, пытаемся загрузить .env вручную
-    env_file = os.path.join(os.path.dirname(__file__), '.env')
-    if os.path.exists(env_file):
-        with open(env_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    os.environ[key] = value
 
-from telegram import Update
-from telegram.ext import (
-    ApplicationBuilder, MessageHandler, CommandHandler,
-    ContextTypes, filters
-)
-# Импортируем ddgs для поиска
-try:
-    from ddgs import DDGS
-    DDGS_AVAILABLE = True
-except ImportError:
-    DDGS_AVAILABLE = None
-from openai import AsyncOpenAI
-import requests
+class Debouncer:
+    """Копит обращения одного человека в чате и отвечает на серию одним запросом к OpenAI.
 
-# ─── ЛОГИ ───────────────────────────────────────────────────────────
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s"
-)
-log = logging.getLogger("mrazz-bot")
+    Хэндлер только кладёт сообщение в буфер и выходит, не занимая очередь чата.
+    Ответ запускает таймер — через тот же диспетчер, так что порядок в чате сохраняется.
+    """
 
-# ─── КОНФИГ ─────────────────────────────────────────────────────────
-TG_TOKEN     = os.getenv("TELEGRAM_BOT_TOKEN")
-OPENAI_KEY   = os.getenv("OPENAI_API_KEY")
-BOT_USERNAME = os.getenv("BOT_USERNAME", "").lstrip("@")
+    def __init__(self):
+        self._bursts = {}  # (chat_id, user_id) -> _Burst
+        self._fired = {}   # update_id ответа на серию -> её более ранние апдейты, пока ответ не завершён
 
-openai = AsyncOpenAI(api_key=OPENAI_KEY)
+    @property
+    def pending(self) -> int:
+        return sum(len(burst.updates) for burst in self._bursts.values())
 
-# Персона бота по умолчанию (нейтральная)
-DEFAULT_STYLE = (
-    "Ты — полезный и дружелюбный ИИ-ассистент. "
-    "Отвечай вежливо, информативно и по делу. "
-    "Можешь использовать юмор, но оставайся уважительным. "
-    "Краткость приветствуется, но давай полные ответы."
-)
+    @staticmethod
+    def window(chat_id: int) -> float:
+        value = CHAT_SETTINGS.get(chat_id, {}).get("debounce")
+        return float(value) if value else 0.0
 
-# Система администраторов
-ADMIN_IDS = set()  # Множество ID администраторов
-SUPER_ADMIN_ID = None  # ID супер-администратора (первый пользователь)
+    def hold(self, update: Update, trigger: Trigger, application) -> bool:
+        """Откладывает сообщение, если в чате включена склейка; False — отвечать сразу"""
+        window = self.window(update.effective_chat.id)
+        if not window or update.effective_user is None:
+            return False
+        loop = asyncio.get_running_loop()
+        key = (update.effective_chat.id, update.effective_user.id)
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _Burst(loop.time())
+        else:
+            burst.timer.cancel()
+        burst.updates.append(update)
+        burst.prompts.append(trigger.prompt)
+        burst.trigger = trigger
+        burst.application = application
+        if len(burst.updates) >= DEBOUNCE_MAX_MESSAGES:
+            delay = 0.0
+        else:
+            # Каждое сообщение продлевает окно, но серия ждёт не дольше трёх окон
+            delay = max(0.0, min(window, burst.started + 3 * window - loop.time()))
+        burst.timer = loop.call_later(delay, self._fire, key)
+        return True
 
-# Файл для сохранения администраторов
-ADMINS_FILE = "/opt/not-your-mama-bot/logs/admins.json"
+    def _fire(self, key):
+        burst = self._bursts.pop(key, None)
+        if burst is None:
+            return
+        update = burst.updates[-1]
+        merged = burst.trigger._replace(prompt="\n".join(p for p in burst.prompts if p))
+        if len(burst.updates) > 1:
+            log.info("Склеено %d сообщений в чате %s от %s", len(burst.updates), key[0], key[1])
+        app = burst.application
+        task = app.create_task(app.update_processor.process_update(update, respond(update, merged)), update=update)
+        if len(burst.updates) > 1:
+            self._fired[update.update_id] = burst.updates[:-1]
+            task.add_done_callback(lambda _: self._fired.pop(update.update_id, None))
 
-def load_admins():
-    """Загружает список администраторов из файла"""
-    global ADMIN_IDS, SUPER_ADMIN_ID
-    try:
-        if os.path.exists(ADMINS_FILE):
-            with open(ADMINS_FILE, 'r') as f:
-                data = json.load(f)
-                ADMIN_IDS = set(data.get('admin_ids', []))
-                SUPER_ADMIN_ID = data.get('super_admin_id')
-                log.info(f"Загружено {len(ADMIN_IDS)} администраторов")
-    except Exception as e:
-        log.warning(f"Ошибка загрузки администраторов: {e}")
+    def with_burst(self, update: Update) -> list:
+        """Апдейт вместе с остальными сообщениями его серии — их откладывают до запуска вместе"""
+        return self._fired.pop(update.update_id, []) + [update]
 
-def save_admins():
-    """Сохраняет список администраторов в файл"""
-    try:
-        data = {
-            'admin_ids': list(ADMIN_IDS),
-            'super_admin_id': SUPER_ADMIN_ID
-        }
-        with open(ADMINS_FILE, 'w') as f:
-            json.dump(data, f)
-        log.info(f"Сохранено {len(ADMIN_IDS)} администраторов")
-    except Exception as e:
-        log.warning(f"Ошибка сохранения администраторов: {e}")
+    def flush(self, spill: Optional[list] = None):
+        """Отвечает на все отложенные серии сразу (при остановке бота).
 
-# Загружаем администраторов при запуске
-load_admins()
+        spill — список апдейтов до следующего запуска: тогда серии не отвечаются,
+        а все их сообщения уходят туда и при повторе склеиваются заново.
+        """
+        for key, burst in list(self._bursts.items()):
+            burst.timer.cancel()
+            if spill is None:
+                self._fire(key)
+            else:
+                del self._bursts[key]
+                spill.extend(burst.updates)
 
-STYLES = {}  # chat_id -> system prompt (живёт в памяти; после рестарта пусто)
 
-MAX_CHUNK = 4000  # предел для сообщений телеги (~4096)
+DEBOUNCER = Debouncer()
+METRICS.gauge("bot_debounce_pending", "Messages held by the debounce stage", lambda: DEBOUNCER.pending)
 
-# ─── УТИЛИТЫ ────────────────────────────────────────────────────────
-def chunk_text(s: str, n: int = MAX_CHUNK):
-    return (s[i:i+n] for i in range(0, len(s), n))
+# ─── ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ ──────────────────────────────────────
+PROFILE_DEFAULT_SECONDS = 15
+PROFILE_MAX_SECONDS     = 120
+PROFILE_TOP             = 8      # строк в каждом разделе отчёта
+PROFILE_SLOW_CALLBACK   = 0.05   # шаг event loop дольше этого считается медленным, сек
+PROFILE_LAG_INTERVAL    = 0.1    # как часто мерить задержку event loop, сек
+# Обвязка event loop, отладочного режима asyncio и самого профилировщика — в отчёте она только мешает
+PROFILE_SKIP_FILES = ("/asyncio/", "selectors.py", "threading.py", "tracemalloc.py",
+                      "traceback.py", "linecache.py", "reprlib.py")
+PROFILE_SKIP_FUNCS = ("<method 'poll' of", "<method 'select' of", "<method 'run' of '_contextvars")
 
-def web_search(query: str, num: int = 5) -> Optional[str]:
-    """Улучшенная функция поиска через DuckDuckGo с обработкой ошибок"""
-    import time
-    
-    # Проверяем версию библиотеки
-    if DDGS_AVAILABLE is True:
-        try:
-            import ddgs
-            log.info(f"DDGS version: {ddgs.__version__}")
-        except:
-            log.warning("Could not get DDGS version")
-    else:
-        log.error("ddgs не установлен")
-        return None
-    
-    try:
-        log.info(f"Starting search for query: '{query}'")
-        
-        # Добавляем небольшую задержку перед запросом
-        time.sleep(0.5)
-        
-        # Создаем DDGS объект
-        try:
-            ddgs = DDGS()
-        except Exception as e:
-            log.warning(f"Failed to create DDGS with default settings: {e}")
-            return None
-        
-        try:
-            # Пробуем разные методы поиска
-            results = None
-            
-            # Метод 1: Обычный текстовый поиск
-            try:
-                log.info(f"Trying text search for: '{query}'")
-                results = list(ddgs.text(query, max_results=num))
-                log.info(f"Text search successful for query: {query}")
-            except Exception as e:
-                log.warning(f"Text search failed for '{query}': {e}")
-                
-                # Метод 2: Поиск новостей (если текстовый не сработал)
-                try:
-                    time.sleep(1)  # Задержка между попытками
-                    log.info(f"Trying news search for: '{query}'")
-                    results = list(ddgs.news(query, max_results=num))
-                    log.info(f"News search successful for query: {query}")
-                except Exception as e2:
-                    log.warning(f"News search also failed for '{query}': {e2}")
-                    return None
-            
-            if not results:
-                log.warning(f"No search results for query: {query}")
-                return None
-                
-            log.info(f"Found {len(results)} results for query: {query}")
-            
-            lines = []
-            for i, r in enumerate(results[:num], 1):
-                title = r.get("title", "Без заголовка")
-                link = r.get("link", "")
-                snippet = r.get("body", "")
-                
-                # Ограничиваем длину сниппета
-                if len(snippet) > 200:
-                    snippet = snippet[:200] + "..."
-                
-                lines.append(f"{i}. **{title}**\n   {snippet}\n   {link}\n")
-            
-            return "\n".join(lines)
-            
-        finally:
-            # Закрываем DDGS объект
-            try:
-                ddgs.close()
-            except:
-                pass
-            
-    except Exception as e:
-        log.error(f"Search error for query '{query}': {e}")
-        return None
 
-async def send_reply(msg, text: str):
-    for ch in chunk_text(text):
-        await msg.reply_text(ch, reply_to_message_id=msg.message_id, disable_web_page_preview=False)
+class _SlowCallbacks(logging.Filter):
+    """Забирает из лога asyncio предупреждения «Executing <...> took N seconds» отладочного режима loop.
 
-# ─── АВТОМАТИЧЕСКАЯ ПРОВЕРКА ОБНОВЛЕНИЙ ──────────────────────────────
-import asyncio
-import aiohttp
-from datetime import datetime, timedelta
+    Фильтр на логгере, а не обработчик: остальные записи asyncio (например,
+    «Task exception was never retrieved») идут в лог как обычно.
+    """
 
-# Переменные для проверки обновлений
-LAST_UPDATE_CHECK = None
-UPDATE_CHECK_INTERVAL = timedelta(hours=1)  # Проверяем каждый час
-LATEST_VERSION = None
-UPDATE_AVAILABLE = False
+    def __init__(self):
+        super().__init__()
+        self.totals = {}  # корутина или колбэк -> [сколько раз, суммарно сек, максимум сек]
 
-def is_auto_update_enabled():
-    """Проверяет, включено ли автообновление через cron"""
-    try:
-        import subprocess
-        import os
-        
-        # Проверяем наличие файла cron-update.sh
-        cron_script = "/opt/not-your-mama-bot/cron-update.sh"
-        if os.path.exists(cron_script):
-            # Проверяем, есть ли задача в crontab
-            process = subprocess.run(
-                ["crontab", "-u", "botuser", "-l"],
-                capture_output=True,
-                text=True
-            )
-            if process.returncode == 0 and "cron-update.sh" in process.stdout:
-                return True
-        
-        return False
-    except Exception as e:
-        log.warning(f"Ошибка проверки автообновления: {e}")
-        return False
+    @staticmethod
+    def _label(handle: str) -> str:
+        match = re.search(r"coro=<([\w.<>]+)\(", handle)
+        if match:
+            return match.group(1) + "()"
+        return re.sub(r" at 0x[0-9a-f]+", "", handle)[:80]
 
-async def check_for_updates():
-    """Проверяет доступность обновлений в GitHub"""
-    global LAST_UPDATE_CHECK, LATEST_VERSION, UPDATE_AVAILABLE
-    
-    try:
-        # Проверяем не чаще чем раз в UPDATE_CHECK_INTERVAL
-        if (LAST_UPDATE_CHECK and 
-            datetime.now() - LAST_UPDATE_CHECK < UPDATE_CHECK_INTERVAL):
-            return
-        
-        LAST_UPDATE_CHECK = datetime.now()
-        
-        # Получаем текущую версию
-        import subprocess
-        process = await asyncio.create_subprocess_exec(
-            "git", "rev-parse", "HEAD",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not str(record.msg).startswith("Executing") or len(record.args) != 2:
+            return True
+        handle, seconds = record.args
+        entry = self.totals.setdefault(self._label(str(handle)), [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        return False  # сотни предупреждений в лог не нужны — они пойдут в отчёт
+
+
+class RuntimeProfiler:
+    """Профилирование работающего бота на заданное время: /profile.
+
+    Пока сеанса нет, ничего не включено и не импортировано. На время сеанса:
+    cProfile на потоке event loop (потоки пула — поиск, SQLite — в него не попадают),
+    замер задержки loop, отладочный режим asyncio для поиска медленных шагов
+    и tracemalloc для мест, где за это время выделено больше всего памяти.
+    """
+
+    def __init__(self):
+        self.running = False  # занят сеансом; флаг ставит и снимает cmd_profile
+
+    async def run(self, seconds: float) -> str:
+        import cProfile
+        import tracemalloc
+
+        loop = asyncio.get_running_loop()
+        profiler = cProfile.Profile()
+        slow = _SlowCallbacks()
+        asyncio_log = logging.getLogger("asyncio")
+        debug, threshold = loop.get_debug(), loop.slow_callback_duration
+        traced_before = tracemalloc.is_tracing()
+        lags = []
+        try:
+            asyncio_log.addFilter(slow)
+            loop.slow_callback_duration = PROFILE_SLOW_CALLBACK
+            loop.set_debug(True)
+            if not traced_before:
+                tracemalloc.start()
+            profiler.enable()
+            deadline = loop.time() + seconds
+            while loop.time() < deadline:
+                expected = loop.time() + PROFILE_LAG_INTERVAL
+                await asyncio.sleep(PROFILE_LAG_INTERVAL)
+                lags.append(max(0.0, loop.time() - expected))
+        finally:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+            current, peak = tracemalloc.get_traced_memory()
+            if not traced_before:
+                tracemalloc.stop()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = threshold
+            asyncio_log.removeFilter(slow)
+        return "\n".join(
+            [f"🔬 Профиль за {seconds:g} с"]
+            + self._lag_report(lags)
+            + self._slow_report(slow.totals)
+            + self._cpu_report(profiler)
+            + self._memory_report(snapshot, current, peak)
         )
-        stdout, stderr = await process.communicate()
-        current_version = stdout.decode('utf-8').strip()
-        
-        # Получаем последнюю версию из GitHub
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://api.github.com/repos/schudarin/not-your-mama-bot/commits/master"
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    latest_commit = data.get('sha', '')
-                    
-                    if latest_commit and latest_commit != current_version:
-                        LATEST_VERSION = latest_commit
-                        UPDATE_AVAILABLE = True
-                        log.info(f"Доступно обновление: {current_version[:8]} -> {latest_commit[:8]}")
-                    else:
-                        UPDATE_AVAILABLE = False
-                        
-    except Exception as e:
-        log.warning(f"Ошибка проверки обновлений: {e}")
 
-async def should_notify_about_updates():
-    """Определяет, нужно ли уведомлять об обновлениях"""
-    # Уведомляем только если автообновление не включено
-    return UPDATE_AVAILABLE and not is_auto_update_enabled()
+    @staticmethod
+    def _lag_report(lags: List[float]) -> List[str]:
+        if not lags:
+            return []
+        lags = sorted(lags)
+        p50, p99 = lags[len(lags) // 2], lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+        return ["", f"⏱ Задержка event loop: p50 {p50 * 1000:.1f} мс, p99 {p99 * 1000:.1f} мс, максимум {lags[-1] * 1000:.1f} мс"]
+
+    @staticmethod
+    def _slow_report(totals: dict) -> List[str]:
+        lines = ["", f"🐢 Шаги event loop дольше {PROFILE_SLOW_CALLBACK * 1000:.0f} мс:"]
+        if not totals:
+            return lines + ["нет"]
+        ranked = sorted(totals.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP]
+        for name, (count, total, longest) in ranked:
+            lines.append(f"{longest * 1000:.0f} мс макс, {count}× всего {total:.2f} с — {name}")
+        return lines
+
+    @staticmethod
+    def _cpu_report(profiler) -> List[str]:
+        import pstats
+
+        stats = pstats.Stats(profiler).stats  # (файл, строка, функция) -> (вызовы, прим., собств., общ., кто вызывал)
+        rows = [
+            (total, own, calls, f"{func} ({os.path.basename(path)}:{line})")
+            for (path, line, func), (_, calls, own, total, _) in stats.items()
+            if not any(part in path for part in PROFILE_SKIP_FILES) and not func.startswith(PROFILE_SKIP_FUNCS)
+        ]
+        rows.sort(reverse=True)
+        lines = ["", "🔥 Функции по общему времени (общее / собственное, вызовов):"]
+        for total, own, calls, name in rows[:PROFILE_TOP]:
+            lines.append(f"{total:.3f} / {own:.3f} с, {calls} — {name}")
+        return lines
 
+    @staticmethod
+    def _memory_report(snapshot, current: int, peak: int) -> List[str]:
+        if snapshot is None:
+            return []
+        lines = ["", f"🧮 Память за сеанс: сейчас {current / 2**20:.1f} МБ, пик {peak / 2**20:.1f} МБ. Больше всего выделяют:"]
+        stats = [
+            stat for stat in snapshot.statistics("lineno")
+            if not any(part in stat.traceback[0].filename for part in PROFILE_SKIP_FILES)
+        ]
+        for stat in stats[:PROFILE_TOP]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:.0f} КБ, {stat.count} блоков — {os.path.basename(frame.filename)}:{frame.lineno}")
+        return lines
 
 
+PROFILER = RuntimeProfiler()
+
 # ─── КОМАНДЫ ───────────────────────────────────────────────────────────
+@needs_state
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or "Без имени"
     
     # Автоматически назначаем первого пользователя супер-администратором
-    global SUPER_ADMIN_ID
-    if SUPER_ADMIN_ID is None:
-        SUPER_ADMIN_ID = user_id
-        ADMIN_IDS.add(user_id)
-        save_admins()  # Сохраняем в файл
-        log.info(f"Назначен супер-администратор: {username} (ID: {user_id})")
+    if SUPER_ADMIN_ID is None and await STORE.claim_super_admin(user_id) == user_id:
+        log.info("Назначен супер-администратор: %s (ID: %s)", username, user_id)
     
     # Логируем всех пользователей для отладки
-    log.info(f"Пользователь {username} (ID: {user_id}) использовал /start")
+    log.info("Пользователь %s (ID: %s) использовал /start", username, user_id)
     
     # Разные сообщения для администраторов и обычных пользователей
     if user_id in ADMIN_IDS:
@@ -290,21 +2969,27 @@ async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 /admin - Управление администраторами
 /style - Настройка стиля бота
 /version - Проверка версии бота
+/usage - Кто сколько тратит токенов
+/queue - Очереди и загрузка
+/profile [секунды] - Профилирование бота
 """
     else:
         admin_commands = ""
     
-    await update.message.reply_text(
+    await answer(
+        update.message,
         f"Привет! Я — {BOT_USERNAME}. 🤖\n\n"
         "📋 Основные команды:\n"
         "• Упоминай меня в группах или используй слово «мразь»\n"
         "• Отвечай на мои сообщения\n"
         "• Для поиска: «гугли», «найди», «поиск», «в интернете»\n"
         "• /style - изменить мой стиль в этом чате\n"
+        "• /debounce - отвечать на серию сообщений одним ответом\n"
         "• /ping - проверить работу бота\n\n"
         f"💬 Личные сообщения: {admin_commands}"
     )
 
+@needs_state
 async def cmd_style(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     current_style = STYLES.get(chat_id, DEFAULT_STYLE)
@@ -312,7 +2997,8 @@ async def cmd_style(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     style = " ".join(ctx.args).strip()
     if not style:
         # Показываем текущий стиль и предлагаем обновить
-        await update.message.reply_text(
+        await answer(
+            update.message,
             f"🎭 Текущий стиль бота в этом чате:\n\n"
             f"«{current_style}»\n\n"
             f"💡 Для изменения отправьте:\n"
@@ -324,28 +3010,64 @@ async def cmd_style(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Обновляем стиль
-    STYLES[chat_id] = style
-    await update.message.reply_text(
+    # Обновляем стиль (запишется в хранилище в фоне)
+    STORE.set_style(chat_id, style)
+    await answer(
+        update.message,
         f"✅ Стиль обновлён для этого чата!\n\n"
         f"🎭 Новый стиль:\n"
         f"«{style}»"
     )
 
+@needs_state
+async def cmd_debounce(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Склейка серий сообщений в этом чате: /debounce [on|off|секунды]"""
+    chat_id = update.effective_chat.id
+    arg = ctx.args[0].lower().replace(",", ".") if ctx.args else ""
+    if not arg:
+        window = DEBOUNCER.window(chat_id)
+        status = f"включена, окно {window:g} с" if window else "выключена"
+        await answer(
+            update.message,
+            f"⏱ Склейка сообщений в этом чате {status}.\n\n"
+            f"Если человек пишет боту несколько сообщений подряд, бот подождёт и ответит на всё разом.\n\n"
+            f"💡 Команды:\n"
+            f"• /debounce on - включить (окно {DEBOUNCE_WINDOW:g} с)\n"
+            f"• /debounce <секунды> - включить с другим окном\n"
+            f"• /debounce off - выключить"
+        )
+        return
+
+    if arg == "off":
+        STORE.set_setting(chat_id, "debounce", None)
+        return await answer(update.message, "✅ Склейка сообщений выключена")
+    if arg == "on":
+        window = DEBOUNCE_WINDOW
+    else:
+        try:
+            window = float(arg)
+        except ValueError:
+            window = 0.0
+        if not 0 < window <= DEBOUNCE_MAX_WINDOW:
+            return await answer(update.message, f"❌ Укажите on, off или окно от 0 до {DEBOUNCE_MAX_WINDOW:g} секунд")
+    STORE.set_setting(chat_id, "debounce", f"{window:g}")
+    await answer(update.message, f"✅ Склейка сообщений включена, окно {window:g} с")
+
 async def cmd_ping(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("pong")
+    await answer(update.message, "pong")
 
+@needs_state
 async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Команда для управления администраторами"""
     user_id = update.effective_user.id
     
     # Проверяем права администратора
     if user_id not in ADMIN_IDS:
-        return await update.message.reply_text("❌ У вас нет прав администратора")
+        return await answer(update.message, "❌ У вас нет прав администратора")
     
     # Проверяем, что это личное сообщение
     if update.effective_chat.type != "private":
-        return await update.message.reply_text("❌ Управление администраторами доступно только в личных сообщениях")
+        return await answer(update.message, "❌ Управление администраторами доступно только в личных сообщениях")
     
     args = ctx.args
     if not args:
@@ -357,7 +3079,8 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             else:
                 admin_list.append(f"🔧 {admin_id}")
         
-        await update.message.reply_text(
+        await answer(
+            update.message,
             f"👥 Список администраторов:\n\n"
             f"{chr(10).join(admin_list)}\n\n"
             f"💡 Команды управления:\n"
@@ -378,32 +3101,32 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             else:
                 admin_list.append(f"🔧 {admin_id}")
         
-        await update.message.reply_text(
+        await answer(
+            update.message,
             f"👥 Список администраторов:\n\n"
             f"{chr(10).join(admin_list)}"
         )
     
     elif action == "add":
         if len(args) < 2:
-            await update.message.reply_text("❌ Укажите ID пользователя: /admin add <ID>")
+            await answer(update.message, "❌ Укажите ID пользователя: /admin add <ID>")
             return
         
         try:
             new_admin_id = int(args[1])
             if new_admin_id in ADMIN_IDS:
-                await update.message.reply_text("✅ Этот пользователь уже администратор")
+                await answer(update.message, "✅ Этот пользователь уже администратор")
                 return
             
-            ADMIN_IDS.add(new_admin_id)
-            save_admins()  # Сохраняем изменения
-            await update.message.reply_text(f"✅ Администратор {new_admin_id} добавлен")
+            STORE.set_admin(new_admin_id, True)  # Сохраняем изменения
+            await answer(update.message, f"✅ Администратор {new_admin_id} добавлен")
             
         except ValueError:
-            await update.message.reply_text("❌ Неверный формат ID. ID должен быть числом")
+            await answer(update.message, "❌ Неверный формат ID. ID должен быть числом")
     
     elif action == "remove":
         if len(args) < 2:
-            await update.message.reply_text("❌ Укажите ID пользователя: /admin remove <ID>")
+            await answer(update.message, "❌ Укажите ID пользователя: /admin remove <ID>")
             return
         
         try:
@@ -411,105 +3134,202 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             
             # Нельзя удалить супер-администратора
             if remove_admin_id == SUPER_ADMIN_ID:
-                await update.message.reply_text("❌ Нельзя удалить супер-администратора")
+                await answer(update.message, "❌ Нельзя удалить супер-администратора")
                 return
             
             if remove_admin_id not in ADMIN_IDS:
-                await update.message.reply_text("❌ Этот пользователь не является администратором")
+                await answer(update.message, "❌ Этот пользователь не является администратором")
                 return
             
-            ADMIN_IDS.remove(remove_admin_id)
-            save_admins()  # Сохраняем изменения
-            await update.message.reply_text(f"✅ Администратор {remove_admin_id} удален")
+            STORE.set_admin(remove_admin_id, False)  # Сохраняем изменения
+            await answer(update.message, f"✅ Администратор {remove_admin_id} удален")
             
         except ValueError:
-            await update.message.reply_text("❌ Неверный формат ID. ID должен быть числом")
+            await answer(update.message, "❌ Неверный формат ID. ID должен быть числом")
     
     else:
-        await update.message.reply_text(
+        await answer(
+            update.message,
             "❌ Неизвестная команда. Используйте:\n"
             "• /admin add <ID> - добавить администратора\n"
             "• /admin remove <ID> - удалить администратора\n"
             "• /admin list - показать список"
         )
 
+@needs_state
+async def cmd_usage(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Топ чатов и пользователей по расходу токенов OpenAI (только для админов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return await answer(update.message, "❌ У вас нет прав администратора")
+
+    try:
+        limit = max(1, min(50, int(ctx.args[0]))) if ctx.args else 10
+    except ValueError:
+        return await answer(update.message, "❌ Использование: /usage [сколько показать]")
+
+    lines = [f"📊 Расход токенов за последние {QUOTA_WINDOW / 60:.0f} мин"]
+    for scope, title in (("chat", "💬 Чаты"), ("user", "👤 Пользователи")):
+        lines.append(f"\n{title}:")
+        rows = LEDGER.top(scope, limit)
+        if not rows:
+            lines.append("— пока пусто")
+        for i, (key, tokens, account) in enumerate(rows, 1):
+            lines.append(
+                f"{i}. {key} — {tokens} ток. "
+                f"(всего {account.prompt}+{account.completion}, запросов {account.requests}, отказов {account.limited})"
+            )
+    quotas = []
+    if USER_TOKEN_QUOTA or CHAT_TOKEN_QUOTA:
+        quotas.append(f"квоты: чат {CHAT_TOKEN_QUOTA or '∞'}, пользователь {USER_TOKEN_QUOTA or '∞'} ток.")
+    quotas.append(f"частота: чат {CHAT_RATE_PER_MIN:g}, пользователь {USER_RATE_PER_MIN:g} в мин. (0 — без лимита)")
+    lines.append("\n⚙️ " + "; ".join(quotas))
+    await answer(update.message, "\n".join(lines))
+
+@needs_state
+async def cmd_queue(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Глубина очередей и загрузка (только для админов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return await answer(update.message, "❌ У вас нет прав администратора")
+
+    processor = ctx.application.update_processor
+    scheduler = processor.scheduler
+    depth = scheduler.depth()
+    titles = {"fast": "⚡ Команды", "chat": "💬 Ответы", "search": "🔍 Поиск"}
+    lines = [f"📥 Обработка: {processor.active} из {processor.limit} слотов занято"]
+    for lane in LANES:
+        lines.append(
+            f"{titles[lane]}: ждут {depth[lane]} из {scheduler.size}, "
+            f"дедлайн {LANE_DEADLINES[lane]:g} с, отброшено {scheduler.dropped[lane]}"
+        )
+    limiter = OPENAI_GUARD.limiter
+    lines += [
+        "",
+        f"📨 Не разобрано апдейтов: {ctx.application.update_queue.qsize()}",
+        f"⏱ Ждут склейки: {DEBOUNCER.pending}",
+        f"🧠 OpenAI: {limiter.inflight} запросов, лимит {limiter.limit:.1f}, ждут {limiter.waiting}",
+        f"📤 Исходящих в очереди: {OUTBOX.depth}",
+    ]
+    await answer(update.message, "\n".join(lines))
+
+@needs_state
+async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Профилирует бота несколько секунд и присылает отчёт (только для админов)"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return await answer(update.message, "❌ У вас нет прав администратора")
+
+    seconds = PROFILE_DEFAULT_SECONDS
+    if ctx.args:
+        try:
+            seconds = float(ctx.args[0])
+        except ValueError:
+            return await answer(update.message, "❌ Использование: /profile [секунды]")
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            return await answer(update.message, f"❌ Длительность — от 1 до {PROFILE_MAX_SECONDS} секунд")
+
+    # Между проверкой и занятием флага не должно быть await: иначе второй /profile проскочит
+    if PROFILER.running:
+        return await answer(update.message, "⏳ Профилирование уже идёт, дождитесь отчёта")
+    PROFILER.running = True
+    try:
+        await answer(update.message, f"🔬 Профилирую {seconds:g} с…")
+        report = await PROFILER.run(seconds)
+    finally:
+        PROFILER.running = False
+    await answer(update.message, report)
+
 async def cmd_version(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Показывает текущую версию бота и информацию об обновлениях"""
     try:
-        import subprocess
-        import asyncio
-        
-        # Получаем текущую версию
-        process = await asyncio.create_subprocess_exec(
-            "git", "rev-parse", "--short", "HEAD",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        current_version = stdout.decode('utf-8').strip() if process.returncode == 0 else "Неизвестно"
-        
-        # Проверяем обновления
-        await check_for_updates()
+        # Всё уже посчитано фоновым UpdateChecker — здесь никакого I/O
+        snapshot = UPDATES.snapshot
+        version_msg = f"🤖 Версия бота: {snapshot.short}"
         
-        version_msg = f"🤖 Версия бота: {current_version}"
-        
-        if UPDATE_AVAILABLE:
-            auto_update_enabled = is_auto_update_enabled()
-            if auto_update_enabled:
+        if snapshot.available:
+            if snapshot.auto_update:
                 version_msg += f"\n\n🆕 Доступно обновление!\n✅ Автообновление включено - обновится автоматически"
             else:
                 version_msg += f"\n\n🆕 Доступно обновление!\n❌ Автообновление отключено\n💡 Для обновления перезапустите контейнер/сервис"
+        elif snapshot.failed:
+            version_msg += "\n\n⚠️ Не удалось проверить обновления"
+            if snapshot.checked_at:
+                version_msg += f" (последняя удачная проверка в {snapshot.checked_at:%H:%M})"
+        elif snapshot.checked_at is None:
+            version_msg += "\n\n⏳ Обновления ещё не проверялись"
         else:
-            version_msg += f"\n\n✅ Бот обновлен до последней версии"
+            version_msg += "\n\n✅ Бот обновлен до последней версии"
+
+        search_stats = SEARCH_CACHE.stats()
+        summary_stats = SUMMARY_CACHE.stats()
+        version_msg += (
+            f"\n\n📦 Кэш поиска: {search_stats['hits']} попаданий, {search_stats['misses']} промахов, "
+            f"{search_stats['coalesced']} объединено"
+            f"\n📦 Кэш саммари: {summary_stats['hits']} попаданий, {summary_stats['misses']} промахов, "
+            f"{summary_stats['coalesced']} объединено"
+        )
         
-        await update.message.reply_text(version_msg)
+        await answer(update.message, version_msg)
         
     except Exception as e:
-        log.error(f"Version check error: {e}")
-        await update.message.reply_text(f"❌ Ошибка при проверке версии: {str(e)}")
+        update_log.error("Version check error: %s", e)
+        await answer(update.message, f"❌ Ошибка при проверке версии: {str(e)}")
 
 # ─── ОСНОВНОЙ ХЭНДЛЕР ───────────────────────────────────────────────
+@needs_state
 async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg        = update.message
     if not msg or not msg.text:
         return
-    text       = msg.text.strip()
-    text_lower = text.lower()
+
+    # 0) РАЗБОР ТРИГГЕРОВ: один проход; в группах без обращения к боту выходим сразу
+    with STAGE_LATENCY.time(stage="trigger"):
+        trigger = match_trigger(msg)
+    if not trigger.addressed:
+        MESSAGES.inc(outcome="ignored")
+        return
+
+    # Серия сообщений от одного человека — одним ответом, если в чате включён /debounce
+    if not trigger.search and DEBOUNCER.hold(update, trigger, ctx.application):
+        MESSAGES.inc(outcome="debounced")
+        return
+    await respond(update, trigger)
+
+async def respond(update: Update, trigger: Trigger):
+    """Ответ на обращение к боту: лимиты, затем поиск или обычный ответ"""
+    msg = update.message
+
+    # Лимиты чата и пользователя — до любых походов в DDG и OpenAI; администраторов не ограничиваем
+    user_id = update.effective_user.id if update.effective_user else msg.chat.id
+    if user_id not in ADMIN_IDS:
+        reason = LEDGER.admit(msg.chat.id, user_id)
+        if reason:
+            MESSAGES.inc(outcome="limited")
+            if LEDGER.should_notice(msg.chat.id):
+                await send_reply(msg, LIMIT_REPLIES[reason])
+            return
+    USAGE_OWNER.set((msg.chat.id, user_id))
+    MESSAGES.inc(outcome="search" if trigger.search else "chat")
 
     # 1) ТРИГГЕР ПОИСКА (ставим раньше обычного ответа)
-    # ловим «интернет/сеть/поиск/гугл/гугли/гуглить/найд»
-    if re.search(r"(интернет|сеть|поиск|гугл(и|я|ить)?|погугл(и|я|ить)?|найд)", text_lower):
-        # Извлекаем поисковый запрос, убирая триггерные слова
-        query = re.sub(r"(интернет|сеть|поиск|гугл(и|я|ить)?|погугл(и|я|ить)?|найд)", "", text, flags=re.IGNORECASE).strip()
-        
-        # Если после удаления триггерных слов ничего не осталось, используем весь текст
-        if not query:
-            query = text.strip()
+    if trigger.search:
+        query = trigger.query
+        search_log.info("Search request: %r", query)
         
-        log.info(f"Search request: '{query}'")
+        # Выполняем поиск (в пуле потоков, event loop не блокируется)
+        results = await web_search(query)
         
-        # Выполняем поиск
-        results_md = web_search(query)
-        
-        if not results_md:
+        if not results:
             return await send_reply(msg, "🔍 Поиск не дал результатов. Попробуйте другой запрос.")
+        # Пользователю — список со ссылками, в OpenAI — сжатый текст без ссылок
+        results_md = format_results(results)
+        prompt_md = search_prompt(results)
         
-        # Саммари найденного через OpenAI
-        try:
-            summary_resp = await openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system",
-                     "content": "Ты помощник для анализа результатов поиска. Кратко резюмируй найденную информацию на русском языке в 2-3 предложения."},
-                    {"role": "user",
-                     "content": f"Проанализируй результаты поиска по запросу '{query}':\n\n{results_md}"}
-                ],
-                temperature=0.3,
-                max_tokens=300
-            )
-            summary = summary_resp.choices[0].message.content
+        # Саммари найденного через OpenAI; при стриминге — только если его нет в кэше
+        if STREAM_REPLIES and SUMMARY_CACHE.get(summary_key(prompt_md)) is None:
+            return await stream_search_reply(msg, query, prompt_md, results_md)
+        try:
+            summary = await summarize_results(query, prompt_md)
         except Exception as e:
-            log.error(f"OpenAI summary error: {e}")
+            log.error("OpenAI summary error: %s", e)
             # Если не удалось создать саммари, отправляем сырые результаты
             return await send_reply(msg, f"🔍 Результаты поиска по запросу «{query}»:\n\n{results_md}")
 
@@ -517,72 +3337,604 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     # 2) ПРОВЕРКА ОБНОВЛЕНИЙ (для администраторов)
     if msg.chat.type == "private" and update.effective_user.id in ADMIN_IDS:
-        await check_for_updates()
-        if await should_notify_about_updates():
-            auto_update_status = "✅ Автообновление включено" if is_auto_update_enabled() else "❌ Автообновление отключено"
-            await send_reply(msg, f"🆕 Доступно обновление бота!\n{auto_update_status}\n💡 Для применения обновления перезапустите контейнер/сервис.")
+        if should_notify_about_updates():
+            await send_reply(msg, "🆕 Доступно обновление бота!\n❌ Автообновление отключено\n💡 Для применения обновления перезапустите контейнер/сервис.")
     
-    # 3) ТРИГГЕР ОБЫЧНОГО ОТВЕТА
-    is_reply_to_bot = (
-        msg.reply_to_message and msg.reply_to_message.from_user
-        and msg.reply_to_message.from_user.username == BOT_USERNAME
+    # 3) ОБЫЧНЫЙ ОТВЕТ
+    prompt = trigger.prompt or "Отвечай в своём стиле."
+    system = STYLES.get(msg.chat.id, DEFAULT_STYLE)
+    history = CONTEXT.build(msg.chat.id, msg.reply_to_message)
+
+    request = dict(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": system},
+            *history,
+            {"role": "user",   "content": prompt},
+        ],
+        temperature=0.7,
     )
-    if msg.chat.type != "private" and not (
-        f"@{BOT_USERNAME}".lower() in text_lower
-        or "мразь" in text_lower
-        or is_reply_to_bot
-    ):
+    if STREAM_REPLIES:
+        result = await stream_chat_reply(msg, request)
+        if result:
+            remember_exchange(msg, prompt, *result)
         return
 
-    # чистим служебное
-    prompt = re.sub(fr"@{re.escape(BOT_USERNAME)}|мразь", "", text, flags=re.IGNORECASE).strip()
-    system = STYLES.get(msg.chat.id, DEFAULT_STYLE)
-
     # 3) Вызов OpenAI
     try:
-        resp = await openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user",   "content": prompt or "Отвечай в своём стиле."},
-            ],
-            temperature=0.7,
-        )
+        resp = await complete("chat", **request)
         answer = resp.choices[0].message.content
     except Exception as e:
         log.warning("OpenAI chat error: %s", e)
         return await send_reply(msg, "Что-то пошло не так. Я починюсь.")
 
     # 4) Отправляем reply
-    await send_reply(msg, answer)
+    sent = await send_reply(msg, answer)
+    remember_exchange(msg, prompt, answer, sent)
+
+async def stream_chat_reply(msg, request: dict):
+    """Обычный ответ в режиме стриминга; возвращает (текст, последнее сообщение) или None"""
+    reply = StreamingReply(msg)
+    await reply.start()
+    try:
+        answer = await stream_completion(reply, "chat", **request)
+    except Exception as e:
+        log.warning("OpenAI chat error: %s", e)
+        separator = "\n\n" if reply.text else ""
+        await reply.finish(separator + "Что-то пошло не так. Я починюсь.")
+        return None
+    await reply.finish()
+    return answer, reply.message
+
+async def stream_search_reply(msg, query: str, prompt_md: str, results_md: str):
+    """Результаты поиска в режиме стриминга: саммари дописывается, список ссылок — в конце"""
+    reply = StreamingReply(msg)
+    await reply.start()
+    await reply.append(f"🔍 По запросу «{query}»:\n\n")
+    try:
+        summary = await stream_completion(reply, "summary", **summary_request(query, prompt_md))
+    except Exception as e:
+        log.error("OpenAI summary error: %s", e)
+        # Если не удалось создать саммари, отправляем сырые результаты
+        await reply.reset(f"🔍 Результаты поиска по запросу «{query}»:\n\n{results_md}")
+        return await reply.finish()
+    SUMMARY_CACHE.put(summary_key(prompt_md), summary)
+    await reply.finish(f"\n\n📋 Подробные результаты:\n{results_md}")
+
+# ─── ВЕБХУК ─────────────────────────────────────────────────────────
+BOT_MODE       = os.getenv("BOT_MODE", "polling").lower()  # polling | webhook
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "")               # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/telegram")     # путь, на который Telegram шлёт апдейты
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT   = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")            # проверяется в X-Telegram-Bot-Api-Secret-Token
+
+
+class WebhookServer:
+    """aiohttp-сервер: принимает апдейты от Telegram и сразу отдаёт их диспетчеру"""
+
+    def __init__(self, app, listen: str, port: int, path: str, secret: str):
+        self.app = app
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+        web_app = web.Application()
+        web_app.router.add_post(self.path, self.handle_update)
+        web_app.router.add_get("/healthz", self.handle_health)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        log.info("Webhook server listening on %s:%s%s", self.listen, self.port, self.path)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_update(self, request):
+        from aiohttp import web
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.app.bot)
+        except Exception as e:
+            log.warning("Bad webhook payload: %s", e)
+            return web.Response(status=400)
+        # Отвечаем сразу: обработка идёт в диспетчере, Telegram не ждёт OpenAI
+        self.app.update_queue.put_nowait(update)
+        return web.Response(status=200)
+
+    async def handle_health(self, request):
+        from aiohttp import web
+        return web.json_response({
+            "status": "ok",
+            "mode": "webhook",
+            "pending_updates": self.app.update_queue.qsize(),
+        })
+
+async def handle_metrics(request):
+    from aiohttp import web
+    return web.Response(
+        text=METRICS.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер только с /metrics (для режима polling)"""
+
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+        web_app = web.Application()
+        web_app.router.add_get("/metrics", handle_metrics)
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        log.info("Metrics available at http://%s:%s/metrics", self.listen, self.port)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+# ─── ПЛАВНАЯ ОСТАНОВКА ──────────────────────────────────────────────
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "20"))  # сколько ждать начатые ответы при остановке, сек
+DEDUP_MAX_AGE = 24 * 3600  # отметке старше суток не верим: после недели тишины Telegram нумерует апдейты заново, берём с запасом
+
+DRAIN_UPDATES = METRICS.counter("bot_drain_updates_total", "Updates finished, saved or aborted on shutdown and replayed on start", ("outcome",))
+
+
+class UpdateJournal:
+    """Отметка последнего принятого update_id и повтор апдейтов, отложенных при остановке.
+
+    Ведёт её процесс, который принимает апдейты из Telegram (одиночный бот или фронт).
+    Всё, что не больше отметки прошлого запуска, уже обработано или лежит в backlog,
+    поэтому повторную доставку тех же апдейтов (вебхук, неподтверждённый getUpdates) пропускаем.
+    """
+
+    def __init__(self):
+        self.tracking = False   # False в воркерах: отметку ведёт фронт
+        self.last_id = None
+        self.skip_until = None
+        self.replay_ids = set()
+        self.last_drain = {}    # отчёт прошлой остановки: {"stopped_at", "seconds"}
+        self.restart_gap = 0.0  # сколько приём апдейтов стоял между запусками, сек
+
+    def admit(self, update: Update) -> bool:
+        """False — апдейт уже обработан прошлым запуском"""
+        if not self.tracking or update.update_id in self.replay_ids:
+            return True
+        if self.skip_until is not None and update.update_id <= self.skip_until:
+            DRAIN_UPDATES.inc(outcome="duplicate")
+            return False
+        if self.last_id is None or update.update_id > self.last_id:
+            self.last_id = update.update_id
+        return True
+
+    async def restore(self, store: StateStore) -> List[dict]:
+        """Читает отметку и отчёт прошлой остановки; возвращает апдейты для повтора"""
+        self.tracking = True
+        try:
+            meta, payloads = await store.take_backlog()
+        except Exception as e:
+            log.warning("Не удалось прочитать отложенные апдейты: %s", e)
+            return []
+        last = meta.get("last_update")
+        if last and time.time() - last["at"] < DEDUP_MAX_AGE:
+            self.skip_until = self.last_id = last["id"]
+        self.last_drain = meta.get("last_drain") or {}
+        self.replay_ids = {data["update_id"] for data in payloads}
+        if payloads:
+            DRAIN_UPDATES.inc(len(payloads), outcome="replayed")
+        return payloads
+
+    def ingesting(self):
+        """Приём апдейтов запущен: считаем, сколько он стоял из-за перезапуска"""
+        if not self.last_drain:
+            return
+        self.restart_gap = time.time() - self.last_drain["stopped_at"]
+        log.info("Перезапуск: приём апдейтов стоял %.1fs (остановка %.1fs), повторяем %d отложенных",
+                 self.restart_gap, self.last_drain["seconds"], len(self.replay_ids))
+
+    def record_stop(self, store: StateStore, stopped_at: float, seconds: float):
+        """Запоминает отметку и время остановки; в базу попадёт при STORE.stop()"""
+        if not self.tracking:
+            return
+        if self.last_id is not None:
+            store.set_meta("last_update", {"id": self.last_id, "at": time.time()})
+        store.set_meta("last_drain", {"stopped_at": stopped_at, "seconds": seconds})
+
+
+UPDATE_JOURNAL = UpdateJournal()
+METRICS.gauge("bot_restart_gap_seconds", "How long update ingestion was down across the last restart", lambda: UPDATE_JOURNAL.restart_gap)
+METRICS.gauge("bot_last_drain_seconds", "How long the previous shutdown took", lambda: UPDATE_JOURNAL.last_drain.get("seconds", 0.0))
+
+
+async def drain_app(app) -> List[dict]:
+    """Доделывает начатое за DRAIN_TIMEOUT; возвращает не начатые апдейты для следующего запуска"""
+    processor = app.update_processor
+    started = time.perf_counter()
+    finished, aborted = await processor.drain(DRAIN_TIMEOUT, app.update_queue.qsize)
+    # Серии, начатые во время остановки, откладываем целиком: отвечать уже некому,
+    # а диспетчер сохранил бы только последнее сообщение серии
+    DEBOUNCER.flush(processor.spilled)
+    # Не дошедшие до диспетчера апдейты забираем сами: app.stop() создал бы для них задачи,
+    # которых уже не ждёт
+    while not app.update_queue.empty():
+        update = app.update_queue.get_nowait()
+        app.update_queue.task_done()
+        if isinstance(update, Update):
+            processor.spilled.append(update)
+    await app.stop()
+    spilled = [update.to_dict() for update in processor.spilled]
+    DRAIN_UPDATES.inc(finished, outcome="finished")
+    DRAIN_UPDATES.inc(len(spilled), outcome="saved")
+    DRAIN_UPDATES.inc(aborted, outcome="aborted")
+    log.info("Остановка за %.1fs: доделано %d, отложено до запуска %d, прервано %d",
+             time.perf_counter() - started, finished, len(spilled), aborted)
+    return spilled
+
+
+async def replay_backlog(app, store: StateStore):
+    """Ставит отложенные прошлым запуском апдейты в очередь раньше новых"""
+    for data in await UPDATE_JOURNAL.restore(store):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+# ─── ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ──────────────────────────────────────
+import multiprocessing
+
+BOT_WORKERS      = int(os.getenv("BOT_WORKERS", "1"))           # 1 — один процесс, как раньше
+WORKER_INDEX     = None  # номер воркера в этом процессе; None — не воркер
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))   # апдейтов в очереди каждого воркера
+
+SHARD_ROUTED = METRICS.counter("bot_shard_updates_total", "Updates routed to worker processes", ("worker",))
+SHARD_RESTARTS = METRICS.counter("bot_shard_restarts_total", "Worker processes restarted after a crash", ("worker",))
+
+
+def shard_of(update: Update, workers: int) -> int:
+    """Номер воркера для апдейта: все апдейты одного чата — в один процесс, порядок сохраняется"""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % workers
+
+
+class ShardPool:
+    """Процессы-воркеры с собственными очередями апдейтов; упавший воркер перезапускается"""
+
+    def __init__(self, workers: int, queue_size: int = SHARD_QUEUE_SIZE):
+        # spawn, а не fork: воркер не наследует event loop, потоки и соединения фронта
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue(queue_size) for _ in range(workers)]
+        self.procs = [None] * workers
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        proc = self._ctx.Process(
+            target=worker_main, args=(index, len(self.queues), self.queues[index]),
+            name=f"bot-worker-{index}", daemon=True,
+        )
+        proc.start()
+        self.procs[index] = proc
+        log.info("Воркер %d запущен (pid %d)", index, proc.pid)
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    async def route(self, update_queue: asyncio.Queue):
+        """Разбирает очередь апдейтов фронта по воркерам"""
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await update_queue.get()
+            if not UPDATE_JOURNAL.admit(update):
+                continue
+            index = shard_of(update, len(self.queues))
+            data = update.to_dict()
+            try:
+                self.queues[index].put_nowait(data)
+            except queue.Full:
+                # Воркер не успевает: ждём места, а не копим апдейты в памяти фронта
+                await loop.run_in_executor(None, self.queues[index].put, data)
+            SHARD_ROUTED.inc(worker=index)
+
+    async def supervise(self, interval: float = 1.0):
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for index, proc in enumerate(self.procs):
+                if not self._stopping and not proc.is_alive():
+                    log.warning("Воркер %d завершился с кодом %s, перезапускаем", index, proc.exitcode)
+                    SHARD_RESTARTS.inc(worker=index)
+                    self._spawn(index)
+
+    async def stop(self, timeout: float = 30.0):
+        """Просит воркеров доделать очередь и выйти; кто не успел — завершается принудительно"""
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        for q in self.queues:
+            await loop.run_in_executor(None, q.put, None)
+        deadline = time.monotonic() + timeout
+        for proc in self.procs:
+            await loop.run_in_executor(None, proc.join, max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                log.warning("Воркер %s не остановился за %.0fс, завершаем", proc.name, timeout)
+                proc.terminate()
+
+
+async def feed_from_front(app, source, stop: asyncio.Event):
+    """В воркере: перекладывает апдейты из очереди фронта в update_queue приложения"""
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            data = await loop.run_in_executor(None, source.get, True, 1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                log.warning("Фронтовый процесс пропал, останавливаемся")
+                break
+            continue
+        if data is None:
+            break
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    stop.set()
+
+
+def worker_main(index: int, workers: int, source):
+    """Точка входа процесса-воркера: обычный бот без приёма апдейтов из Telegram"""
+    global TG_GLOBAL_RATE, OUTBOX, METRICS_PORT, WORKER_INDEX
+    WORKER_INDEX = index
+    # Останавливает воркера фронт (через очередь), сигналы терминала и systemd — ему
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging()
+    # Общий лимит Telegram делится между воркерами; лимиты чатов — нет, чат живёт в одном воркере
+    TG_GLOBAL_RATE = TG_GLOBAL_RATE / workers
+    OUTBOX = OutboundQueue()
+    if METRICS_PORT:
+        METRICS_PORT += index + 1
+    log.info("Воркер %d/%d стартует", index, workers)
+    STARTUP.mark("import")
+    app = build_app(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES), ingest=False)
+    STARTUP.mark("build")
+    asyncio.run(run_bot(app, source))
+
+
+async def run_front(workers: int):
+    """Фронтовый процесс: принимает апдейты и раздаёт их воркерам по chat_id"""
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    builder = ApplicationBuilder().token(TG_TOKEN)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app = builder.build()  # без хэндлеров и app.start(): update_queue разбирает ShardPool.route
+
+    pool = ShardPool(workers)
+    METRICS.gauge("bot_update_queue_depth", "Updates received but not dispatched yet", app.update_queue.qsize)
+    METRICS.gauge("bot_shard_queue_depth", "Updates waiting in worker queues", pool.depth)
+    metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+    server = None
+    await app.initialize()
+    pool.start()
+    router = asyncio.create_task(pool.route(app.update_queue))
+    supervisor = asyncio.create_task(pool.supervise())
+    try:
+        if metrics_server:
+            await metrics_server.start()
+        await replay_backlog(app, STORE)
+        server = await start_ingestion(app)
+        UPDATE_JOURNAL.ingesting()
+        log.info("Front is up as @%s (%s), %d workers", BOT_USERNAME, BOT_MODE, workers)
+        await stop.wait()
+    finally:
+        stopped_at, started = time.time(), time.perf_counter()
+        await stop_ingestion(app, server)
+        # Уже принятые апдейты отдаём воркерам, прежде чем их останавливать
+        deadline = time.monotonic() + 5
+        while not app.update_queue.empty() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in (router, supervisor):
+            task.cancel()
+        await asyncio.gather(router, supervisor, return_exceptions=True)
+        await pool.stop(DRAIN_TIMEOUT + 15)  # воркеры сами доделывают начатое и откладывают остальное
+        UPDATE_JOURNAL.record_stop(STORE, stopped_at, time.perf_counter() - started)
+        await STORE.stop()
+        if metrics_server:
+            await metrics_server.stop()
+        await app.shutdown()
 
 # ─── ЗАПУСК ─────────────────────────────────────────────────────────
-def main():
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+class StartupTimer:
+    """Разбивка времени запуска по фазам: от старта интерпретатора до приёма апдейтов"""
+
+    def __init__(self, started: float):
+        self.phases: dict[str, float] = {}
+        self._last = started
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def report(self) -> str:
+        total = sum(self.phases.values())
+        parts = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        return f"{total:.2f}s ({parts})"
+
+STARTUP = StartupTimer(STARTED_AT)
+METRICS.gauge("bot_startup_seconds", "Startup time by phase", lambda: dict(STARTUP.phases), labels=("phase",))
+WARMUP_MODULES = ("openai", "numpy")  # тяжёлые импорты, которые грузятся лениво
+
+def warm_up():
+    """Импортирует тяжёлые модули в потоке, пока бот уже принимает апдейты"""
+    started = time.perf_counter()
+    for name in WARMUP_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    log.info("Модули %s прогреты за %.2fs", ", ".join(WARMUP_MODULES), time.perf_counter() - started)
+
+async def on_startup(app):
+    """Запускает фоновые сервисы, которым нужен работающий event loop"""
+    await STORE.start()  # состояние читается в фоне; хэндлеры с @needs_state его дождутся
+    OUTBOX.start(app.bot)
+    # GitHub и crontab опрашивает один процесс; остальные воркеры берут снимок из STATE_DB
+    if not WORKER_INDEX:
+        await UPDATES.start()
+
+async def on_stop(app):
+    """Досылает исходящие сообщения, пока у бота ещё есть HTTP-клиент"""
+    await OUTBOX.stop()
+    await STORE.stop()
+
+async def on_error(update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Необработанные исключения хэндлеров: в лог и в метрики"""
+    count_error("handler", ctx.error)
+    log.error("Unhandled error while processing update", exc_info=ctx.error)
+
+async def on_shutdown(app):
+    """Освобождает ресурсы при остановке бота"""
+    await UPDATES.stop()
+    SEARCH.close()
+
+async def start_ingestion(app):
+    """Запускает приём апдейтов от Telegram (polling или вебхук); возвращает сервер вебхука"""
+    if BOT_MODE != "webhook":
+        await app.updater.start_polling()
+        return None
+    # Без секрета любой, кто знает адрес, мог бы прислать поддельный апдейт
+    # (в том числе «/admin add» от имени админа), поэтому пустой секрет заменяем случайным
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        log.warning("WEBHOOK_SECRET не задан: используется случайный секрет до перезапуска")
+    server = WebhookServer(app, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, secret)
+    await server.start()
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+        )
+    else:
+        log.warning("WEBHOOK_URL не задан: вебхук в Telegram не зарегистрирован (локальный режим)")
+    return server
+
+async def stop_ingestion(app, server):
+    if app.updater and app.updater.running:
+        await app.updater.stop()
+    if server:
+        await server.stop()
+
+def install_stop_signals(stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+async def run_bot(app, source=None):
+    """Жизненный цикл бота: то же, что run_polling(), но с выбором режима приёма апдейтов.
+
+    source — очередь от фронтового процесса (режим BOT_WORKERS > 1): апдейты берутся
+    из неё, а не из Telegram, и остановкой управляет фронт.
+    """
+    stop = asyncio.Event()
+    if source is None:
+        install_stop_signals(stop)
+
+    server = feeder = None
+    metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+    await app.initialize()
+    STARTUP.mark("initialize")
+    try:
+        await on_startup(app)
+        await app.start()
+        if metrics_server:
+            await metrics_server.start()
+        STARTUP.mark("services")
+        if source is None:
+            await replay_backlog(app, STORE)
+            server = await start_ingestion(app)
+            UPDATE_JOURNAL.ingesting()
+        else:
+            feeder = asyncio.create_task(feed_from_front(app, source, stop))
+        STARTUP.mark("ingestion")
+        asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+        log.info("Bot is up as @%s (%s)", BOT_USERNAME, BOT_MODE if source is None else "worker")
+        log.info("Startup: %s", STARTUP.report())
+        await stop.wait()
+    finally:
+        stopped_at, started = time.time(), time.perf_counter()
+        await stop_ingestion(app, server)
+        DEBOUNCER.flush()
+        if feeder:
+            feeder.cancel()
+            await asyncio.gather(feeder, return_exceptions=True)
+        if metrics_server:
+            await metrics_server.stop()
+        if app.running:
+            # Новых апдейтов больше нет: доделываем начатое, остальное откладываем до запуска
+            await STORE.save_backlog(await drain_app(app))
+            UPDATE_JOURNAL.record_stop(STORE, stopped_at, time.perf_counter() - started)
+            await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+def build_app(dispatcher: ChatOrderedUpdateProcessor, ingest: bool = True):
+    builder = (
+        ApplicationBuilder()
+        .token(TG_TOKEN)
+        .concurrent_updates(dispatcher)
+    )
+    if BOT_MODE == "webhook" or not ingest:
+        builder = builder.updater(None)
+    app = builder.build()
+    METRICS.gauge("bot_handlers_active", "Updates being handled right now", lambda: dispatcher.active)
+    METRICS.gauge(
+        "bot_lane_queue_depth", "Updates waiting for a handler slot, by priority lane",
+        lambda: dispatcher.scheduler.depth() if dispatcher.scheduler else {}, labels=("lane",),
+    )
+    METRICS.gauge("bot_update_queue_depth", "Updates received but not dispatched yet", app.update_queue.qsize)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("style", cmd_style))
     app.add_handler(CommandHandler("ping",  cmd_ping))
     app.add_handler(CommandHandler("admin", cmd_admin))
     app.add_handler(CommandHandler("version", cmd_version))
+    app.add_handler(CommandHandler("usage", cmd_usage))
+    app.add_handler(CommandHandler("debounce", cmd_debounce))
+    app.add_handler(CommandHandler("queue", cmd_queue))
+    app.add_handler(CommandHandler("profile", cmd_profile))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
-    
-    # Запускаем фоновую задачу проверки обновлений
-    async def background_updates():
-        await asyncio.sleep(10)  # Ждем 10 секунд перед первой проверкой
-        while True:
-            try:
-                await check_for_updates()
-            except Exception as e:
-                log.error(f"Ошибка в периодической проверке обновлений: {e}")
-            await asyncio.sleep(3600)  # Проверяем каждый час
-    
-    # Создаем фоновую задачу
-    loop = asyncio.get_event_loop()
-    loop.create_task(background_updates())
-    
-    log.info("Bot is up as @%s", BOT_USERNAME)
-    app.run_polling()
+    app.add_error_handler(on_error)
+    return app
 
+def main():
+    setup_logging()
+    STARTUP.mark("import")
+    if BOT_WORKERS > 1:
+        asyncio.run(run_front(BOT_WORKERS))
+        return
+    app = build_app(ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    STARTUP.mark("build")
+    asyncio.run(run_bot(app))
 
 
 if __name__ == "__main__":
@@ -97,7 +97,7 @@ fi
 
 # Проверяем, запущен ли бот через systemd
 if systemctl is-active --quiet not-your-mama-bot; then
-    echo "🔄 Перезапуск службы systemd..."
+    echo "🔄 Перезапуск службы systemd (бот доделает начатые ответы)..."
     sudo systemctl restart not-your-mama-bot
     echo "✅ Служба перезапущена"
 else